@@ -0,0 +1,346 @@
+import re
+import ssl
+import time
+import random
+import asyncio
+import hashlib
+try:
+    from urllib import unquote
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import unquote, urlparse
+
+import certifi
+import httpx
+
+from api.client import ID_PATH, USER_AGENT, parse_bundles, search_client_id, write_client_id
+from api.ratelimit import RateLimiter
+
+
+class AsyncClient():
+
+	# The same API as Client, as coroutines on httpx, so many URLs and manifests can be
+	# resolved at once on a single event loop. Call start() before anything else.
+
+	# (retries, base backoff in secs) per endpoint, keyed by first path segment.
+	retry_policies = {
+		'default': (4, 1),
+		'me': (2, 1),
+		'resolve': (3, 1),
+		'manifest': (4, 0.5),
+		'cdn': (3, 0.5)
+	}
+
+	# Minimum secs between client ID rescans.
+	id_refresh_interval = 600
+
+	def __init__(self, cookies, pool_size=10, cache=None, limiters=None, seg_retries=3, stats=None,
+			base='https://api-v2.soundcloud.com/', web_base='https://soundcloud.com/', timeout=(10, 60)):
+		self.cache = cache
+		self.stats = stats
+		self.limiters = limiters or {
+			'api': RateLimiter(10),
+			'cdn': RateLimiter(50)
+		}
+		self.retry_policies = dict(self.retry_policies, cdn=(seg_retries, 0.5))
+		# (connect, read) secs. Waiting for a pooled connection isn't a stall, so that's
+		# left unbounded; the rate limiter already spaces requests out.
+		self.timeout = httpx.Timeout(timeout[1], connect=timeout[0], pool=None)
+		# Loading the CA bundle is a good part of startup, so both sessions share one.
+		self.ssl_context = ssl.create_default_context(cafile=certifi.where())
+		oauth_token = cookies.get('oauth_token')
+		if oauth_token == None:
+			raise Exception(
+				'Cookies were dumped whilst not logged in. Please redump them.')
+		self.session = self.make_session(pool_size, {'Authorization': 'OAuth ' + oauth_token})
+		# The web app, its bundles and download redirects don't need (or get) the OAuth token.
+		self.web = self.make_session(pool_size)
+		self.base = base
+		self.web_base = web_base
+		self.id_lock = None
+		self.id_checked = None
+		self.token_hash = hashlib.sha256(oauth_token.encode('UTF-8')).hexdigest()[:16]
+		self.locale = cookies['sclocale']
+
+	def make_session(self, pool_size, headers=None):
+		return httpx.AsyncClient(
+			headers=dict({'User-Agent': USER_AGENT, 'Referer': 'https://soundcloud.com/'}, **(headers or {})),
+			limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+			timeout=self.timeout, verify=self.ssl_context, follow_redirects=True)
+
+	async def start(self):
+		# Created here so it belongs to the loop the client runs on.
+		self.id_lock = asyncio.Lock()
+		self.app_ver, self.client_id = await self.read_client_id()
+		self.plan = await self._get_plan()
+
+	async def close(self):
+		await self.session.aclose()
+		await self.web.aclose()
+
+	def get_pool_stats(self):
+		stats = {}
+		for name, session in (('api', self.session), ('web', self.web)):
+			for conn in session._transport._pool.connections:
+				# e.g. "'https://api-v2.soundcloud.com:443', HTTP/1.1, IDLE, Request Count: 3"
+				match = re.match(r"'(?:https?://)?([^':]+)[^']*'.*Request Count: (\d+)", conn.info())
+				if match == None:
+					continue
+				pool = stats.setdefault((name, match.group(1)), {
+					'session': name,
+					'host': match.group(1),
+					'connections': 0,
+					'requests': 0
+				})
+				pool['connections'] += 1
+				pool['requests'] += int(match.group(2))
+		return list(stats.values())
+
+	def get_retry_after(self, r):
+		try:
+			return min(float(r.headers['Retry-After']), 300)
+		except (KeyError, ValueError):
+			return None
+
+	async def request(self, session, url, policy='default', limiter='api', method='GET', **kwargs):
+		if self.stats == None:
+			return await self._request(session, url, policy, limiter, method, **kwargs)
+		with self.stats.timed('http ' + policy):
+			r = await self._request(session, url, policy, limiter, method, **kwargs)
+		self.stats.add_request(urlparse(url).netloc, len(r.content))
+		return r
+
+	async def _request(self, session, url, policy, limiter, method, **kwargs):
+		retries, backoff = self.retry_policies.get(policy, self.retry_policies['default'])
+		limiter = self.limiters[limiter]
+		for attempt in range(retries+1):
+			delay = min(backoff * 2**attempt, 30) * random.uniform(0.5, 1.5)
+			await limiter.acquire_async()
+			try:
+				r = await session.request(method, url, **kwargs)
+			except httpx.TransportError:
+				if attempt == retries:
+					raise
+				await asyncio.sleep(delay)
+				continue
+			if r.status_code == 429 or r.status_code >= 500:
+				retry_after = self.get_retry_after(r)
+				if r.status_code == 429:
+					limiter.throttled(retry_after)
+				if attempt < retries:
+					await asyncio.sleep(retry_after or delay)
+					continue
+			else:
+				limiter.succeeded()
+			r.raise_for_status()
+			return r
+
+	async def read_client_id(self):
+		try:
+			with open(ID_PATH) as f:
+				app_ver, client_id = f.read().split()
+		except (IOError, ValueError):
+			return await self.find_client_id()
+		return app_ver, client_id
+
+	async def find_client_id(self):
+		r = await self.request(self.web, self.web_base + 'discover', limiter='cdn')
+		app_ver, urls = parse_bundles(r.text)
+
+		async def get(url):
+			try:
+				return (await self.request(self.web, url, limiter='cdn')).text
+			except Exception:
+				# A bundle that fails to load just doesn't have it; another one might.
+				return ''
+
+		# The ID lives in one of the later bundles.
+		tasks = [asyncio.ensure_future(get(url)) for url in reversed(urls)]
+		try:
+			for task in asyncio.as_completed(tasks):
+				client_id = search_client_id(await task)
+				if client_id != None:
+					write_client_id(app_ver, client_id)
+					return app_ver, client_id
+		finally:
+			for task in tasks:
+				task.cancel()
+		raise Exception('Couldn\'t find a client ID in any bundle.')
+
+	async def refresh_client_id(self, stale):
+		# Returns whether there's a different ID to retry with.
+		async with self.id_lock:
+			# Another request may have already replaced it.
+			if self.client_id != stale:
+				return True
+			# 401/403 also come from expired tokens and region or permission limits, which a
+			# new ID won't fix, so rescans are spaced out and an unchanged ID is no retry.
+			now = time.monotonic()
+			if self.id_checked != None and now - self.id_checked < self.id_refresh_interval:
+				return False
+			self.id_checked = now
+			self.app_ver, self.client_id = await self.find_client_id()
+			return self.client_id != stale
+
+	async def request_with_id(self, url, policy, params):
+		# A rotated client ID comes back as 401/403; find the new one and retry once.
+		client_id = self.client_id
+		params['client_id'] = client_id
+		try:
+			return await self.request(self.session, url, policy=policy, params=params)
+		except httpx.HTTPStatusError as e:
+			if not e.response.status_code in (401, 403) or not await self.refresh_client_id(client_id):
+				raise
+		params['client_id'] = self.client_id
+		if 'app_version' in params:
+			params['app_version'] = self.app_ver
+		return await self.request(self.session, url, policy=policy, params=params)
+
+	async def make_call(self, epoint, params=None):
+		if self.cache != None:
+			resp = self.cache.get(epoint, params)
+			if resp != None:
+				return resp
+		policy = epoint.split('/')[0]
+		if params != None:
+			r = await self.request_with_id(self.base + epoint, policy, params)
+		else:
+			r = await self.request(self.session, self.base + epoint, policy=policy)
+		resp = r.json()
+		if self.cache != None:
+			self.cache.set(epoint, params, resp)
+		return resp
+
+	async def get_me(self):
+		# Cached under a hash of the token rather than plain "me", so switching
+		# accounts never picks up the previous one's plan.
+		key = 'me/' + self.token_hash
+		if self.cache != None:
+			resp = self.cache.get(key)
+			if resp != None:
+				return resp
+		r = await self.request(self.session, self.base + 'me', policy='me')
+		resp = r.json()
+		if self.cache != None:
+			self.cache.set(key, None, {
+				'id': resp['id'],
+				'likes_count': resp.get('likes_count'),
+				'consumer_subscription': resp['consumer_subscription']
+			})
+		return resp
+
+	async def _get_plan(self):
+		resp = await self.get_me()
+		self.user_id = str(resp['id'])
+		self.likes_count = resp.get('likes_count')
+		plans = {
+			'free': 'free',
+			'pro-unlimited': 'Pro Unlimited',
+			'consumer-high-tier': 'Go+',
+			'consumer-high-dj-tier': 'Go+ DJ'
+		}
+		plan = plans[resp['consumer_subscription']['product']['id']]
+		return plan
+
+	def get_plan(self):
+		return self.plan
+
+	async def gather(self, func, items):
+		# item -> result, or the exception it raised, so one failure doesn't sink the rest.
+		results = await asyncio.gather(*[func(x) for x in items], return_exceptions=True)
+		return dict(zip(items, results))
+
+	async def get_metadata(self, url):
+		params = {
+			'url': url
+		}
+		resp = await self.make_call('resolve', params=params)
+		return resp
+
+	async def get_artist_id(self, url):
+		# Resolving the profile URL is much lighter than scraping the page, and gets cached.
+		resp = await self.get_metadata(url.rsplit('/', 1)[0])
+		return str(resp['id'])
+
+	async def get_artist_info(self, url):
+		artist_id = await self.get_artist_id(url)
+		params = {
+			'app_version': self.app_ver,
+			'app_locale': self.locale
+		}
+		resp = await self.make_call('users/' + artist_id, params=params)
+		return resp
+
+	async def paginate(self, epoint, limit):
+		params = {
+			'offset': 0,
+			'limit': limit,
+			'app_version': self.app_ver,
+			'app_locale': self.locale
+		}
+		while True:
+			resp = await self.make_call(epoint, params=params)
+			for item in resp['collection']:
+				yield item
+			if resp['next_href'] == None:
+				break
+			offset = unquote(resp['next_href'].split('?offset=')[-1].split('&')[0])
+			if '-' in offset:
+				params['offset'] = offset
+			else:
+				params['offset'] += len(resp['collection'])
+
+	def get_artist_albums(self, artist_id):
+		return self.paginate('users/' + artist_id + '/albums', 10)
+
+	def get_artist_tracks(self, artist_id):
+		return self.paginate('users/' + artist_id + '/tracks', 20)
+
+	def get_user_likes(self):
+		return self.paginate('users/' + self.user_id + '/track_likes', 24)
+
+	def get_likes_count(self):
+		return self.likes_count
+
+	async def get_track_batch(self, track_ids):
+		params = {
+			'ids': ','.join(str(x) for x in track_ids),
+			'app_version': self.app_ver,
+			'app_locale': self.locale
+		}
+		return await self.make_call('tracks', params=params)
+
+	async def get_tracks(self, track_ids):
+		tracks = {}
+		missing = []
+		for track_id in track_ids:
+			track = None
+			if self.cache != None:
+				track = self.cache.get('tracks/' + str(track_id))
+			if track != None:
+				tracks[track_id] = track
+			else:
+				missing.append(track_id)
+		# The endpoint takes up to 50 IDs per call.
+		batches = [missing[i:i+50] for i in range(0, len(missing), 50)]
+		for resp in await asyncio.gather(*[self.get_track_batch(x) for x in batches]):
+			for track in resp:
+				tracks[track['id']] = track
+				if self.cache != None:
+					self.cache.set('tracks/' + str(track['id']), None, track)
+		return tracks
+
+	async def get_manifest(self, url):
+		r = await self.request(self.session, url, policy='manifest')
+		manifest_url = r.json()['url']
+		r = await self.request(self.session, manifest_url, policy='manifest')
+		return r.text
+
+	async def get_file(self, track_id):
+		url = '{}tracks/{}/download'.format(self.base, track_id)
+		r = await self.request_with_id(url, 'default', {
+			'app_version': self.app_ver, 'app_locale': self.locale})
+		file_url = r.json()['redirectUri']
+		r = await self.request(self.web, file_url, policy='cdn', limiter='cdn', method='HEAD')
+		fname = r.headers['Content-Disposition'].split('"')[1]
+		return fname, '.' + fname.split('.')[-1], file_url
@@ -0,0 +1,105 @@
+import json
+import time
+import sqlite3
+import threading
+try:
+    from urllib import urlencode
+except ImportError:
+    from urllib.parse import urlencode
+
+
+class Cache():
+
+	def __init__(self, path, ttls, max_entries=50000, refresh=False):
+		self.ttls = ttls
+		self.max_entries = max_entries
+		self.refresh = refresh
+		self.writes = 0
+		# Access times of cache hits, written out in batches rather than a commit per hit.
+		self.touched = {}
+		self.lock = threading.Lock()
+		self.conn = sqlite3.connect(path, check_same_thread=False)
+		with self.conn:
+			self.conn.execute(
+				'CREATE TABLE IF NOT EXISTS cache '
+				'(key TEXT PRIMARY KEY, value TEXT, expires REAL, accessed REAL)')
+			self.conn.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+
+	def make_key(self, epoint, params):
+		# client_id and app_version rotate, but don't change what comes back.
+		params = sorted(
+			(k, v) for k, v in (params or {}).items() if not k in ('client_id', 'app_version'))
+		return epoint + '?' + urlencode(params)
+
+	def get_ttl(self, epoint):
+		# users/123/track_likes -> users/track_likes, falling back to users.
+		kind = '/'.join(x for x in epoint.split('/') if not x.isdigit())
+		ttl = self.ttls.get(kind)
+		if ttl == None:
+			ttl = self.ttls.get(kind.split('/')[0], 0)
+		return ttl
+
+	def get(self, epoint, params=None):
+		if self.refresh == True or not self.get_ttl(epoint):
+			return None
+		key = self.make_key(epoint, params)
+		now = time.time()
+		with self.lock:
+			row = self.conn.execute(
+				'SELECT value, expires FROM cache WHERE key = ?', (key,)).fetchone()
+			if row == None:
+				return None
+			if row[1] < now:
+				self.touched.pop(key, None)
+				with self.conn:
+					self.conn.execute('DELETE FROM cache WHERE key = ?', (key,))
+				return None
+			self.touched[key] = now
+			if len(self.touched) >= 100:
+				self.flush_touched()
+		return json.loads(row[0])
+
+	def set(self, epoint, params, value):
+		ttl = self.get_ttl(epoint)
+		if not ttl:
+			return
+		key = self.make_key(epoint, params)
+		now = time.time()
+		with self.lock:
+			self.touched.pop(key, None)
+			with self.conn:
+				self.conn.execute(
+					'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)',
+					(key, json.dumps(value), now + ttl, now))
+			self.writes += 1
+			if self.writes % 100 == 0:
+				self.evict()
+
+	def flush_touched(self):
+		if not self.touched:
+			return
+		with self.conn:
+			self.conn.executemany(
+				'UPDATE cache SET accessed = ? WHERE key = ?',
+				[(v, k) for k, v in self.touched.items()])
+		self.touched = {}
+
+	def evict(self):
+		# Eviction goes by access time, so pending ones are written out first.
+		self.flush_touched()
+		count = self.conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+		if count <= self.max_entries:
+			return
+		with self.conn:
+			count -= self.conn.execute(
+				'DELETE FROM cache WHERE expires < ?', (time.time(),)).rowcount
+			if count > self.max_entries:
+				self.conn.execute(
+					'DELETE FROM cache WHERE key IN '
+					'(SELECT key FROM cache ORDER BY accessed LIMIT ?)',
+					(count - self.max_entries,))
+
+	def close(self):
+		with self.lock:
+			self.evict()
+			self.conn.close()
@@ -1,173 +1,206 @@
 import re
 import os
-import sys
 import time
+import random
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 try:
-    from urllib import unquote
+    from urlparse import urlparse
 except ImportError:
-    from urllib.parse import unquote
+    from urllib.parse import urlparse
 
 import requests
+from requests.adapters import HTTPAdapter
+
+from api.ratelimit import RateLimiter
+
+
+ID_PATH = os.path.join('api', 'id')
+USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
+			  '(KHTML, like Gecko) Chrome/89.0.4389.114 Safari/537.36')
+
+def parse_bundles(html):
+	# The web app version and its script bundles, from the discover page.
+	match = re.search(r'<script>window.__sc_version="(\d{10})"</script>', html)
+	urls = re.findall(r'<script crossorigin src="([^"]+)"', html)
+	if match == None or not urls:
+		raise Exception('Couldn\'t find the web app version or bundles.')
+	return match.group(1), urls
+
+def search_client_id(body):
+	match = re.search(r'client_id=([a-zA-Z\d]{32})', body)
+	if match == None:
+		return None
+	return match.group(1)
+
+def write_client_id(app_ver, client_id, path=ID_PATH):
+	with open(path, 'w') as f:
+		f.write(app_ver + '\n' + client_id)
+
+def find_client_id(get, web_base='https://soundcloud.com/', workers=8):
+	# get(url) returns the body text; the caller decides which session and limits apply.
+	app_ver, urls = parse_bundles(get(web_base + 'discover'))
+	pool = ThreadPoolExecutor(max_workers=workers)
+	try:
+		# The ID lives in one of the later bundles.
+		futures = [pool.submit(get, url) for url in reversed(urls)]
+		for future in as_completed(futures):
+			try:
+				body = future.result()
+			except Exception:
+				# A bundle that fails to load just doesn't have it; another one might.
+				continue
+			client_id = search_client_id(body)
+			if client_id != None:
+				return app_ver, client_id
+	finally:
+		pool.shutdown(wait=False, cancel_futures=True)
+	raise Exception('Couldn\'t find a client ID in any bundle.')
 
 
 class Client():
 
-	def __init__(self, cookies):
-		self.session = requests.Session()
-		self.session.headers.update({
-			'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
-						  '(KHTML, like Gecko) Chrome/89.0.4389.114 Safari/537.36',
+	# A thin blocking wrapper over AsyncClient, which runs on an event loop of its own so
+	# every thread's API calls share it. Segment and file bodies stay on requests, as
+	# they're read a chunk at a time under the bandwidth cap.
+	def __init__(self, cookies, pool_size=10, cache=None, api_rate=10, cdn_rate=50, seg_retries=3,
+			stats=None, base='https://api-v2.soundcloud.com/', web_base='https://soundcloud.com/',
+			timeout=(10, 60)):
+		self.stats = stats
+		self.limiters = {
+			'api': RateLimiter(api_rate),
+			'cdn': RateLimiter(cdn_rate)
+		}
+		# (connect, read) secs. A stalled read raises Timeout, so it's retried like any other
+		# failed attempt rather than blocking a worker for good.
+		self.timeout = tuple(timeout)
+		# httpx is a good part of startup, so it's only imported once there's a client to make.
+		from api.async_client import AsyncClient
+		self.loop = asyncio.new_event_loop()
+		threading.Thread(target=self.loop.run_forever, daemon=True).start()
+		self.aclient = AsyncClient(
+			cookies, pool_size=pool_size, cache=cache, limiters=self.limiters, seg_retries=seg_retries,
+			stats=stats, base=base, web_base=web_base, timeout=timeout)
+		self.retry_policies = self.aclient.retry_policies
+		self.cdn = self.make_session(pool_size)
+		self.run(self.aclient.start())
+
+	def run(self, coro):
+		return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+	def iterate(self, agen):
+		# Pulls an async generator's items through the loop one at a time.
+		while True:
+			try:
+				item = self.run(agen.__anext__())
+			except StopAsyncIteration:
+				return
+			yield item
+
+	def make_session(self, pool_size):
+		session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+		session.mount('https://', adapter)
+		session.mount('http://', adapter)
+		session.headers.update({
+			'User-Agent': USER_AGENT,
 			'Referer': 'https://soundcloud.com/'
 		})
-		self.base = 'https://api-v2.soundcloud.com/'
-		oauth_token = cookies.get('oauth_token')
-		if oauth_token == None:
-			raise Exception(
-				'Cookies were dumped whilst not logged in. Please redump them.')
-		self.session.headers.update({
-			'Authorization': 'OAuth ' + oauth_token
-		})
-		self.app_ver, self.client_id = self.read_client_id()
-		self.plan = self._get_plan()
-		self.locale = cookies['sclocale']
-
-	def read_client_id(self):
-		path = os.path.join('api', 'id')
-		with open(path) as f:
-			app_ver, app_id = f.readlines()
-		return app_ver, app_id
-
-	def make_call(self, epoint, params=None):
-		if params != None:
-			params['client_id'] = self.client_id
-		r = self.session.get(self.base + epoint, params=params)
-		r.raise_for_status()
-		return r.json()
-
-	def _get_plan(self):
-		resp = self.make_call('me')
-		self.user_id = str(resp['id'])
-		plans = {
-			'free': 'free',
-			'pro-unlimited': 'Pro Unlimited',
-			'consumer-high-tier': 'Go+',
-			'consumer-high-dj-tier': 'Go+ DJ'
-		}
-		plan = plans[resp['consumer_subscription']['product']['id']]
-		return plan
+		return session
+
+	def get_pool_stats(self):
+		stats = self.aclient.get_pool_stats()
+		pools = self.cdn.get_adapter('https://').poolmanager.pools
+		for key in pools.keys():
+			pool = pools.get(key)
+			if pool == None:
+				continue
+			stats.append({
+				'session': 'cdn',
+				'host': pool.host,
+				'connections': pool.num_connections,
+				'requests': pool.num_requests
+			})
+		return stats
+
+	def request(self, session, url, policy='default', limiter='api', method='GET', **kwargs):
+		if self.stats == None:
+			return self._request(session, url, policy, limiter, method, **kwargs)
+		with self.stats.timed('http ' + policy):
+			r = self._request(session, url, policy, limiter, method, **kwargs)
+		# Streamed bodies are counted by whoever reads them.
+		nbytes = 0 if kwargs.get('stream') else len(r.content)
+		self.stats.add_request(urlparse(url).netloc, nbytes)
+		return r
+
+	def _request(self, session, url, policy, limiter, method, **kwargs):
+		retries, backoff = self.retry_policies.get(policy, self.retry_policies['default'])
+		limiter = self.limiters[limiter]
+		for attempt in range(retries+1):
+			delay = min(backoff * 2**attempt, 30) * random.uniform(0.5, 1.5)
+			limiter.acquire()
+			try:
+				r = session.request(method, url, timeout=self.timeout, **kwargs)
+			except (requests.ConnectionError, requests.Timeout):
+				if attempt == retries:
+					raise
+				time.sleep(delay)
+				continue
+			if r.status_code == 429 or r.status_code >= 500:
+				retry_after = self.aclient.get_retry_after(r)
+				if r.status_code == 429:
+					limiter.throttled(retry_after)
+				if attempt < retries:
+					r.close()
+					time.sleep(retry_after or delay)
+					continue
+			else:
+				limiter.succeeded()
+			r.raise_for_status()
+			return r
 
 	def get_plan(self):
-		return self.plan
+		return self.aclient.get_plan()
+
+	def get_likes_count(self):
+		return self.aclient.get_likes_count()
+
+	def get_user_id(self):
+		return self.aclient.user_id
 
 	def get_metadata(self, url):
-		params = {
-			'url': url
-		}
-		resp = self.make_call('resolve', params=params)
-		return resp
+		return self.run(self.aclient.get_metadata(url))
+
+	def get_metadata_batch(self, urls):
+		# url -> metadata, or the exception resolving it raised. All of them go out
+		# together on the loop, paced by the API rate limiter.
+		return self.run(self.aclient.gather(self.aclient.get_metadata, urls))
 
 	def get_artist_id(self, url):
-		r = self.session.get(url)
-		r.raise_for_status()
-		match = re.search(r'content="soundcloud://users:(\d+)">', r.text)
-		return match.group(1)
+		return self.run(self.aclient.get_artist_id(url))
 
 	def get_artist_info(self, url):
-		artist_id = self.get_artist_id(url)
-		params = {
-			'app_version': self.app_ver,
-			'app_locale': self.locale	
-		}
-		resp = self.make_call('users/' + artist_id, params=params)
-		return resp
+		return self.run(self.aclient.get_artist_info(url))
 
 	def get_artist_albums(self, artist_id):
-		meta = []
-		offset = 0
-		params = {
-			'offset': offset,
-			'limit': 10,
-			'app_version': self.app_ver,
-			'app_locale': self.locale	
-		}
-		while True:
-			resp = self.make_call('users/' + artist_id + '/albums', params=params)
-			if resp['next_href'] != None:
-				offset = unquote(resp['next_href'].split('?offset=')[-1].split('&')[0])			
-				if '-' in offset:
-					params['offset'] = offset
-				else:
-					params['offset'] += len(resp['collections'])
-			# A generator would be better, but then we wouldn't be able to get a total properly.
-			meta.append(resp['collection'])
-			if resp['next_href'] == None:
-				break
-			time.sleep(0.2)
-		return meta	
+		return self.iterate(self.aclient.get_artist_albums(artist_id))
 
 	def get_artist_tracks(self, artist_id):
-		meta = []
-		offset = 0
-		params = {
-			'offset': offset,
-			'limit': 20,
-			'app_version': self.app_ver,
-			'app_locale': self.locale	
-		}
-		while True:
-			resp = self.make_call('users/' + artist_id + '/tracks', params=params)
-			if resp['next_href'] != None:
-				offset = unquote(resp['next_href'].split('?offset=')[-1].split('&')[0])			
-				if '-' in offset:
-					params['offset'] = offset
-				else:
-					params['offset'] += len(resp['collections'])
-			# A generator would be better, but then we wouldn't be able to get a total properly.
-			meta.append(resp['collection'])
-			if resp['next_href'] == None:
-				break
-			time.sleep(0.2)
-		return meta
+		return self.iterate(self.aclient.get_artist_tracks(artist_id))
 
 	def get_user_likes(self):
-		meta = []
-		offset = 0
-		params = {
-			'offset': offset,
-			'limit': 24,
-			'app_version': self.app_ver,
-			'app_locale': self.locale	
-		}
-		while True:
-			resp = self.make_call('users/' + self.user_id + '/track_likes', params=params)
-			if resp['next_href'] != None:
-				offset = unquote(resp['next_href'].split('?offset=')[-1].split('&')[0])			
-				if '-' in offset:
-					params['offset'] = offset
-				else:
-					params['offset'] += len(resp['collections'])
-			# A generator would be better, but then we wouldn't be able to get a total properly.
-			meta.append(resp['collection'])
-			if resp['next_href'] == None:
-				break
-			time.sleep(0.2)
-		return meta
+		return self.iterate(self.aclient.get_user_likes())
+
+	def get_tracks(self, track_ids):
+		return self.run(self.aclient.get_tracks(track_ids))
 
 	def get_manifest(self, url):
-		r = self.session.get(url)
-		r.raise_for_status()
-		manifest_url = r.json()['url']
-		r = self.session.get(manifest_url)
-		r.raise_for_status()
-		return r.text
+		return self.run(self.aclient.get_manifest(url))
 
 	def get_file(self, track_id):
-		url = '{}tracks/{}/download'.format(self.base, track_id)
-		r = self.session.get(url, params={
-			'client_id': self.client_id, 'app_version': self.app_ver, 'app_locale': self.locale})
-		r.raise_for_status()
-		file_url = r.json()['redirectUri']
-		r = self.session.head(file_url)
-		r.raise_for_status()
-		fname = r.headers['Content-Disposition'].split('"')[1]
-		return fname, '.' + fname.split('.')[-1], file_url
\ No newline at end of file
+		return self.run(self.aclient.get_file(track_id))
+
+	def fetch(self, url, headers=None, stream=False):
+		return self.request(
+			self.cdn, url, policy='cdn', limiter='cdn', headers=headers, stream=stream)
@@ -0,0 +1,94 @@
+import time
+import asyncio
+import threading
+
+
+class RateLimiter():
+
+	def __init__(self, rate, burst=None, min_rate=None):
+		self.max_rate = float(rate)
+		self.rate = self.max_rate
+		self.min_rate = min_rate or self.max_rate / 20
+		self.capacity = burst or self.max_rate
+		self.tokens = self.capacity
+		self.updated = time.monotonic()
+		self.blocked_until = 0
+		self.lock = threading.Lock()
+
+	def reserve(self, amount=1):
+		# Returns how long the caller has to wait before using what it reserved.
+		with self.lock:
+			now = time.monotonic()
+			self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+			# Callers reserve up front and sleep off any debt outside the lock,
+			# so waiting threads are served in arrival order.
+			self.tokens -= amount
+			return max(-self.tokens / self.rate, self.blocked_until - now)
+
+	def acquire(self, amount=1):
+		wait = self.reserve(amount)
+		if wait > 0:
+			time.sleep(wait)
+
+	async def acquire_async(self, amount=1):
+		# Shared with threads calling acquire, so both kinds of caller queue together.
+		wait = self.reserve(amount)
+		if wait > 0:
+			await asyncio.sleep(wait)
+
+	def throttled(self, retry_after=None):
+		with self.lock:
+			self.rate = max(self.min_rate, self.rate / 2)
+			if retry_after != None:
+				self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+	def succeeded(self):
+		if self.rate >= self.max_rate:
+			return
+		with self.lock:
+			self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+	def set_rate(self, rate):
+		with self.lock:
+			self.max_rate = self.rate = float(rate)
+			self.min_rate = self.max_rate / 20
+			self.capacity = self.max_rate
+			self.tokens = min(self.tokens, self.capacity)
+
+
+class BandwidthGovernor():
+
+	# Caps the aggregate bytes/sec across every transfer. schedule is a list of
+	# {"from": "HH:MM", "to": "HH:MM", "limit_mb": n} windows (which may wrap past
+	# midnight) overriding limit_mb; a limit of 0 means uncapped.
+	def __init__(self, limit_mb=0, schedule=None):
+		self.default = limit_mb * 1024 * 1024
+		self.schedule = [
+			(self.parse_time(x['from']), self.parse_time(x['to']), x['limit_mb'] * 1024 * 1024)
+			for x in schedule or []]
+		self.rate = None
+		self.limiter = RateLimiter(1)
+
+	def parse_time(self, value):
+		hours, mins = value.split(':')
+		return int(hours) * 60 + int(mins)
+
+	def get_rate(self):
+		if not self.schedule:
+			return self.default
+		now = time.localtime()
+		mins = now.tm_hour * 60 + now.tm_min
+		for start, end, rate in self.schedule:
+			if start <= mins < end or (start > end and (mins >= start or mins < end)):
+				return rate
+		return self.default
+
+	def consume(self, nbytes):
+		rate = self.get_rate()
+		if rate != self.rate:
+			self.rate = rate
+			if rate > 0:
+				self.limiter.set_rate(rate)
+		if rate > 0:
+			self.limiter.acquire(nbytes)
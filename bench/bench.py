@@ -0,0 +1,133 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+import mock_server
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = {
+	'set': ['https://soundcloud.com/artist1/sets/set-101'],
+	'likes': ['https://soundcloud.com/you/likes'],
+	'tracks': ['https://soundcloud.com/artist2/tracks'],
+	'albums': ['https://soundcloud.com/artist1/albums'],
+	'in_set': [
+		'https://soundcloud.com/artist1/track-{}?in=artist1/sets/set-102'.format(x) for x in range(1021, 1031)],
+	# Best quality, so tracks with a download button are fetched through it.
+	'downloads': ['https://soundcloud.com/artist2/tracks']
+}
+# sc-dl.py arguments a scenario needs, ahead of any passed after --.
+SCENARIO_ARGS = {
+	'downloads': ['-q', '4']
+}
+# Everything else the stand-in serves is media, not API.
+API_KINDS = ('me', 'resolve', 'users', 'tracks', 'media')
+
+
+def setup(workdir, port, quality):
+	shutil.copy(os.path.join(ROOT, 'sc-dl.py'), workdir)
+	for name in ('api', 'utils'):
+		shutil.copytree(
+			os.path.join(ROOT, name), os.path.join(workdir, name),
+			ignore=shutil.ignore_patterns('__pycache__'))
+	with open(os.path.join(ROOT, 'config.json'), encoding='UTF-8') as f:
+		cfg = json.load(f)
+	cfg['api_base'] = cfg['web_base'] = 'http://127.0.0.1:{}/'.format(port)
+	cfg['output_path'] = 'out'
+	cfg['quality'] = quality
+	with open(os.path.join(workdir, 'config.json'), 'w', encoding='UTF-8') as f:
+		json.dump(cfg, f, indent=4)
+	with open(os.path.join(workdir, 'cookies.txt'), 'w', encoding='UTF-8') as f:
+		f.write('.soundcloud.com\tTRUE\t/\tTRUE\t0\toauth_token\tbench\n')
+		f.write('.soundcloud.com\tTRUE\t/\tTRUE\t0\tsclocale\ten\n')
+
+def count_output(path):
+	tracks = nbytes = 0
+	for root, _, fnames in os.walk(path):
+		for fname in fnames:
+			if fname.endswith(('.mp3', '.m4a', '.ogg')):
+				tracks += 1
+				nbytes += os.path.getsize(os.path.join(root, fname))
+	return tracks, nbytes
+
+def run(server, name, urls, args, extra):
+	workdir = tempfile.mkdtemp(prefix='sc-dl-bench-')
+	try:
+		setup(workdir, server.server_address[1], args.quality)
+		with server.lock:
+			server.counts = {}
+		start = time.perf_counter()
+		proc = subprocess.run(
+			[sys.executable, 'sc-dl.py', '--report', 'report.json', '-u'] + urls
+			+ SCENARIO_ARGS.get(name, []) + extra,
+			cwd=workdir, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+		elapsed = time.perf_counter() - start
+		if proc.returncode != 0:
+			print(proc.stderr.decode('UTF-8', 'replace'))
+		tracks, nbytes = count_output(os.path.join(workdir, 'out'))
+		with server.lock:
+			counts = dict(server.counts)
+		api_calls = sum(v for k, v in counts.items() if k in API_KINDS)
+		return {
+			'scenario': name,
+			'tracks': tracks,
+			'secs': round(elapsed, 3),
+			'tracks_per_sec': round(tracks / elapsed, 3),
+			'mb_per_sec': round(nbytes / 1024**2 / elapsed, 3),
+			'api_calls': api_calls,
+			'api_calls_per_track': round(api_calls / max(tracks, 1), 3),
+			'requests': counts
+		}
+	finally:
+		if not args.keep:
+			shutil.rmtree(workdir, ignore_errors=True)
+
+def parse_args():
+	parser = argparse.ArgumentParser(
+		description='Runs sc-dl.py end to end against a local SoundCloud stand-in. '
+					'Arguments after -- are passed to sc-dl.py.')
+	parser.add_argument('-s', '--scenarios', nargs='+', default=sorted(SCENARIOS), choices=sorted(SCENARIOS))
+	parser.add_argument('-r', '--runs', default=1, type=int)
+	parser.add_argument('-q', '--quality', default=2, type=int, help='2 (MP3) avoids needing ffmpeg.')
+	parser.add_argument('--port', default=0, type=int)
+	parser.add_argument('--latency', default=0.02, type=float, help='Seconds added to every response.')
+	parser.add_argument('--bandwidth', default=0, type=int, help='Bytes/sec per response, 0 for unlimited.')
+	parser.add_argument('--error-rate', default=0.0, type=float, help='Fraction of requests failed with 429/5xx.')
+	parser.add_argument('--expires', default=3600, type=int, help='Secs until signed segment URLs expire.')
+	parser.add_argument('--segments', default=10, type=int, help='Segments per track.')
+	parser.add_argument('--seg-size', default=32*1024, type=int)
+	parser.add_argument('--downloadable-every', default=3, type=int,
+		help='Every nth track offers a download button file, 0 for none.')
+	parser.add_argument('--json', help='Also write the results to this path.')
+	parser.add_argument('--keep', action='store_true', help='Keep the temp working folders.')
+	argv = sys.argv[1:]
+	extra = []
+	if '--' in argv:
+		extra = argv[argv.index('--')+1:]
+		argv = argv[:argv.index('--')]
+	return parser.parse_args(argv), extra
+
+def main():
+	args, extra = parse_args()
+	server = mock_server.serve(args)
+	results = []
+	print('{:<10} {:>6} {:>8} {:>10} {:>8} {:>12}'.format(
+		'scenario', 'tracks', 'secs', 'tracks/s', 'MB/s', 'API/track'))
+	for name in args.scenarios:
+		for _ in range(args.runs):
+			result = run(server, name, SCENARIOS[name], args, extra)
+			results.append(result)
+			print('{scenario:<10} {tracks:>6} {secs:>8.2f} {tracks_per_sec:>10.2f} '
+				  '{mb_per_sec:>8.2f} {api_calls_per_track:>12.2f}'.format(**result))
+	server.shutdown()
+	if args.json:
+		with open(args.json, 'w', encoding='UTF-8') as f:
+			json.dump(results, f, indent=4)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,306 @@
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+try:
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from urllib.parse import urlparse, parse_qs
+
+
+# 128 Kbps, 44.1 kHz MPEG-1 Layer III frame header, padded out to a full frame.
+MP3_FRAME = b'\xff\xfb\x90\x64' + b'\x00' * 413
+JPEG = b'\xff\xd8\xff\xe0' + b'\x00' * 2000 + b'\xff\xd9'
+
+
+class World():
+
+	def __init__(self, users=2, sets=3, set_size=20, tracks=40, likes=60, segments=10,
+			seg_size=32*1024, stub_after=5, downloadable_every=0, file_size=1024*1024):
+		self.segments = segments
+		self.seg_size = seg_size
+		self.stub_after = stub_after
+		self.file_size = file_size
+		self.users = {}
+		self.tracks = {}
+		self.sets = {}
+		track_id = 1000
+		for u in range(1, users+1):
+			user = {
+				'id': u,
+				'username': 'artist{}'.format(u),
+				'permalink': 'artist{}'.format(u),
+				'permalink_url': 'https://soundcloud.com/artist{}'.format(u),
+				'avatar_url': 'https://i1.sndcdn.com/avatars-{}-large.jpg'.format(u),
+				'track_count': tracks,
+				'likes_count': likes
+			}
+			self.users[u] = user
+			user['track_ids'] = []
+			for _ in range(tracks):
+				track_id += 1
+				self.tracks[track_id] = self.make_track(track_id, user, downloadable_every)
+				user['track_ids'].append(track_id)
+			user['set_ids'] = []
+			for n in range(1, sets+1):
+				set_id = u*100 + n
+				ids = user['track_ids'][(n-1)*set_size % tracks:][:set_size]
+				self.sets[set_id] = {
+					'id': set_id,
+					'kind': 'playlist',
+					'title': 'Set {}'.format(set_id),
+					'permalink_url': '{}/sets/set-{}'.format(user['permalink_url'], set_id),
+					'artwork_url': 'http://{{host}}/art/artworks-set{}-large.jpg'.format(set_id),
+					'genre': 'Test',
+					'user': self.public_user(user),
+					'track_ids': ids
+				}
+				user['set_ids'].append(set_id)
+		self.me = self.users[1]
+		self.app_ver = '1600000000'
+		self.client_id = 'b' * 32
+		self.like_ids = sorted(self.tracks)[-likes:]
+
+	def make_track(self, track_id, user, downloadable_every):
+		base = 'http://{host}/'
+		return {
+			'id': track_id,
+			'kind': 'track',
+			'title': 'Track {}'.format(track_id),
+			'permalink_url': '{}/track-{}'.format(user['permalink_url'], track_id),
+			'artwork_url': 'http://{{host}}/art/artworks-{}-large.jpg'.format(track_id),
+			'release_date': '2021-01-01T00:00:00Z',
+			'duration': self.segments * 10000,
+			'full_duration': self.segments * 10000,
+			'created_at': '2021-01-01T00:00:00Z',
+			'streamable': True,
+			'policy': 'ALLOW',
+			'monetization_model': 'NOT_APPLICABLE',
+			'downloadable': bool(downloadable_every) and track_id % downloadable_every == 0,
+			'has_downloads_left': True,
+			'user': self.public_user(user),
+			'media': {
+				'transcodings': [{
+					'url': base + 'media/{}/mp3'.format(track_id),
+					'format': {'protocol': 'hls', 'mime_type': 'audio/mpeg'}
+				}, {
+					'url': base + 'media/{}/mp3-progressive'.format(track_id),
+					'format': {'protocol': 'progressive', 'mime_type': 'audio/mpeg'}
+				}]
+			}
+		}
+
+	def public_user(self, user):
+		return {k: v for k, v in user.items() if not k.endswith('_ids')}
+
+
+class Handler(BaseHTTPRequestHandler):
+
+	protocol_version = 'HTTP/1.1'
+
+	def log_message(self, *args):
+		pass
+
+	def fill(self, obj, host):
+		return json.loads(json.dumps(obj).replace('http://{host}/', 'http://{}/'.format(host)))
+
+	def send_json(self, obj):
+		body = json.dumps(self.fill(obj, self.headers['Host'])).encode('UTF-8')
+		self.send_body(body, 'application/json')
+
+	def send_body(self, body, ctype, status=200, headers=None):
+		self.send_response(status)
+		self.send_header('Content-Type', ctype)
+		self.send_header('Content-Length', str(len(body)))
+		for k, v in (headers or {}).items():
+			self.send_header(k, v)
+		self.end_headers()
+		if self.command == 'HEAD':
+			return
+		rate = self.server.opts.bandwidth
+		if rate <= 0:
+			self.wfile.write(body)
+			return
+		chunk = 16*1024
+		for i in range(0, len(body), chunk):
+			self.wfile.write(body[i:i+chunk])
+			time.sleep(len(body[i:i+chunk]) / rate)
+
+	def send_error_status(self, status):
+		self.send_body(b'{}', 'application/json', status=status, headers={'Retry-After': '1'})
+
+	def page(self, items, path, query):
+		offset = int(query.get('offset', ['0'])[0])
+		limit = int(query.get('limit', ['20'])[0])
+		chunk = items[offset:offset+limit]
+		next_href = None
+		if offset + limit < len(items):
+			next_href = 'http://{{host}}/{}?offset={}&limit={}'.format(path, offset+limit, limit)
+		return {'collection': chunk, 'next_href': next_href}
+
+	def resolve(self, url):
+		world = self.server.world
+		path = urlparse(url).path.strip('/').split('/')
+		user = next((u for u in world.users.values() if u['permalink'] == path[0]), None)
+		if user == None:
+			return None
+		if len(path) == 1 or path[1] in ('tracks', 'albums'):
+			return world.public_user(user)
+		if path[1] == 'sets':
+			set_id = int(path[2].split('-')[-1])
+			return self.playlist(world.sets[set_id])
+		return world.tracks.get(int(path[1].split('-')[-1]))
+
+	def playlist(self, _set):
+		world = self.server.world
+		meta = {k: v for k, v in _set.items() if k != 'track_ids'}
+		meta['tracks'] = [
+			world.tracks[x] if n < world.stub_after else {'id': x, 'kind': 'track'}
+			for n, x in enumerate(_set['track_ids'])]
+		meta['track_count'] = len(_set['track_ids'])
+		return meta
+
+	def discover(self):
+		host = self.headers['Host']
+		html = '<script>window.__sc_version="{}"</script>'.format(self.server.world.app_ver)
+		for n in range(6):
+			html += '<script crossorigin src="http://{}/assets/{}.js"></script>'.format(host, n)
+		return html.encode('UTF-8')
+
+	def do_HEAD(self):
+		self.do_GET()
+
+	def do_GET(self):
+		opts = self.server.opts
+		self.server.count(self.path)
+		if opts.latency > 0:
+			time.sleep(opts.latency)
+		if opts.error_rate > 0 and random.random() < opts.error_rate:
+			return self.send_error_status(random.choice((429, 500, 503)))
+		world = self.server.world
+		parsed = urlparse(self.path)
+		path = parsed.path.strip('/')
+		query = parse_qs(parsed.query)
+		parts = path.split('/')
+		if path == 'discover':
+			return self.send_body(self.discover(), 'text/html')
+		if parts[0] == 'assets':
+			found = parts[1] == '3.js'
+			body = 'client_id={}'.format(world.client_id if found else 'x').encode('UTF-8')
+			return self.send_body(body, 'application/javascript')
+		if 'client_id' in query and query['client_id'][0] != world.client_id:
+			return self.send_error_status(401)
+		if path == 'me':
+			return self.send_json(dict(world.public_user(world.me), consumer_subscription={
+				'product': {'id': 'consumer-high-tier'}}))
+		if path == 'resolve':
+			meta = self.resolve(query['url'][0])
+			if meta == None:
+				return self.send_error_status(404)
+			return self.send_json(meta)
+		if parts[0] == 'users' and len(parts) == 2:
+			return self.send_json(world.public_user(world.users[int(parts[1])]))
+		if parts[0] == 'users' and len(parts) == 3:
+			user = world.users[int(parts[1])]
+			if parts[2] == 'tracks':
+				items = [world.tracks[x] for x in reversed(user['track_ids'])]
+			elif parts[2] == 'albums':
+				items = [self.playlist(world.sets[x]) for x in user['set_ids']]
+			else:
+				items = [{'track': world.tracks[x]} for x in reversed(world.like_ids)]
+			return self.send_json(self.page(items, path, query))
+		if path == 'tracks':
+			ids = [int(x) for x in query['ids'][0].split(',')]
+			return self.send_json([world.tracks[x] for x in ids if x in world.tracks])
+		if parts[0] == 'tracks' and parts[-1] == 'download':
+			return self.send_json({'redirectUri': 'http://{host}/file/' + parts[1]})
+		if parts[0] == 'media':
+			return self.send_json({'url': 'http://{{host}}/playlist/{}.m3u8'.format(parts[1])})
+		if parts[0] == 'playlist':
+			track_id = parts[1].split('.')[0]
+			host = self.headers['Host']
+			lines = ['#EXTM3U', '#EXT-X-VERSION:6', '#EXT-X-TARGETDURATION:10']
+			expires = int(time.time()) + opts.expires
+			for n in range(world.segments):
+				lines.append('#EXTINF:10.0,')
+				lines.append('http://{}/seg/{}/{}?Expires={}'.format(host, track_id, n, expires))
+			lines.append('#EXT-X-ENDLIST')
+			return self.send_body(('\n'.join(lines) + '\n').encode('UTF-8'), 'application/vnd.apple.mpegurl')
+		if parts[0] == 'seg':
+			if int(query['Expires'][0]) < time.time():
+				return self.send_error_status(403)
+			frames = max(world.seg_size // len(MP3_FRAME), 1)
+			return self.send_body(MP3_FRAME * frames, 'audio/mpeg')
+		if parts[0] == 'file':
+			return self.send_file(parts[1])
+		if parts[0] == 'art':
+			return self.send_body(JPEG, 'image/jpeg')
+		self.send_error_status(404)
+
+	def send_file(self, track_id):
+		size = self.server.world.file_size
+		body = (MP3_FRAME * (size // len(MP3_FRAME) + 1))[:size]
+		headers = {
+			'Content-Disposition': 'attachment; filename="track-{}.mp3"'.format(track_id),
+			'Accept-Ranges': 'bytes'
+		}
+		match = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+		if match == None:
+			return self.send_body(body, 'audio/mpeg', headers=headers)
+		start = int(match.group(1))
+		end = int(match.group(2)) if match.group(2) else size - 1
+		headers['Content-Range'] = 'bytes {}-{}/{}'.format(start, end, size)
+		self.send_body(body[start:end+1], 'audio/mpeg', status=206, headers=headers)
+
+
+class Server(ThreadingHTTPServer):
+
+	daemon_threads = True
+
+	def __init__(self, addr, world, opts):
+		ThreadingHTTPServer.__init__(self, addr, Handler)
+		self.world = world
+		self.opts = opts
+		self.lock = threading.Lock()
+		self.counts = {}
+
+	def count(self, path):
+		kind = urlparse(path).path.strip('/').split('/')[0]
+		with self.lock:
+			self.counts[kind] = self.counts.get(kind, 0) + 1
+
+
+def parse_args(argv=None):
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--port', default=8650, type=int)
+	parser.add_argument('--latency', default=0.0, type=float, help='Seconds added to every response.')
+	parser.add_argument('--bandwidth', default=0, type=int, help='Bytes/sec per response, 0 for unlimited.')
+	parser.add_argument('--error-rate', default=0.0, type=float, help='Fraction of requests failed with 429/5xx.')
+	parser.add_argument('--expires', default=3600, type=int, help='Secs until signed segment URLs expire.')
+	parser.add_argument('--segments', default=10, type=int)
+	parser.add_argument('--seg-size', default=32*1024, type=int)
+	parser.add_argument('--downloadable-every', default=0, type=int,
+		help='Every nth track offers a download button file, 0 for none.')
+	return parser.parse_args(argv)
+
+def serve(opts):
+	world = World(segments=opts.segments, seg_size=opts.seg_size,
+		downloadable_every=opts.downloadable_every)
+	server = Server(('127.0.0.1', opts.port), world, opts)
+	t = threading.Thread(target=server.serve_forever, daemon=True)
+	t.start()
+	return server
+
+if __name__ == '__main__':
+	opts = parse_args()
+	server = serve(opts)
+	print('Serving on http://127.0.0.1:{}/'.format(opts.port))
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		sys.exit()
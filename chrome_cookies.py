@@ -9,6 +9,8 @@ import win32crypt
 from Cryptodome.Cipher import AES
 
 
+HOSTS = ('.soundcloud.com', 'api-auth.soundcloud.com', 'soundcloud.com')
+
 def get_key(local_state_path):
 	with open(local_state_path) as f:
 		encrypted_key = json.load(f)['os_crypt']['encrypted_key']
@@ -29,10 +31,10 @@ def get_cookies(cookies_path, key):
 	conn.text_factory = lambda x: handle_decode(x)
 	cursor = conn.cursor()
 	try:
-		cursor.execute('SELECT host_key, name, value, encrypted_value FROM cookies')
-		for host, name, value, encrypted_value in cursor.fetchall():
-			if not host in ('.soundcloud.com', 'api-auth.soundcloud.com', 'soundcloud.com'):
-				continue
+		# Filtered in SQLite, so only SoundCloud's rows are read and decrypted.
+		cursor.execute(
+			'SELECT name, encrypted_value FROM cookies WHERE host_key IN (?, ?, ?)', HOSTS)
+		for name, encrypted_value in cursor:
 			cipher = AES.new(key, AES.MODE_GCM, nonce=encrypted_value[3:3+12])
 			decrypted_value = cipher.decrypt_and_verify(encrypted_value[3+12:-16], encrypted_value[-16:])
 			parsed[name] = decrypted_value.decode('UTF-8')
@@ -54,6 +56,16 @@ def write_cookies(parsed):
 		for k, v in parsed.items():
 			f.write('{}\t{}\n'.format(k, v))
 
+def get_paths():
+	user_data_path = os.path.join(os.getenv('localappdata'), 'Google', 'Chrome', 'User Data')
+	local_state_path = os.path.join(user_data_path, 'Local State')
+	cookies_path = os.path.join(user_data_path, 'Default', 'Cookies')
+	return local_state_path, cookies_path
+
+def read_cookies():
+	local_state_path, cookies_path = get_paths()
+	return get_cookies(cookies_path, get_key(local_state_path))
+
 def main(local_state_path, cookies_path):
 	key = get_key(local_state_path)
 	while True:
@@ -68,11 +80,8 @@ def main(local_state_path, cookies_path):
 	print('OK.')
 
 if __name__ == '__main__':
-	user_data_path = os.path.join(os.getenv('localappdata'), 'Google', 'Chrome', 'User Data')
-	local_state_path = os.path.join(user_data_path, 'Local State')
-	cookies_path = os.path.join(user_data_path, 'Default', 'Cookies')
 	try:
-		main(local_state_path, cookies_path)
+		main(*get_paths())
 	except Exception:
 		traceback.print_exc()
 	finally:
@@ -1,38 +1,21 @@
 import os
-import re
 import sys
-import json
 import traceback
 
 import requests
 
+from api.client import find_client_id, write_client_id
 
-def write_id(app_ver, client_id):
-	path = os.path.join('api', 'id')
-	with open(path, 'w') as f:
-		f.write(app_ver + '\n' + client_id)
-	
-def extract_src_urls():
-	r = session.get('https://soundcloud.com/discover')
-	r.raise_for_status()
-	html = r.text
-	match = re.search(r'<script>window.__sc_version="(\d{10})"</script>', html)
-	matches = re.findall(r'<script crossorigin src="([^"]+)"', html)
-	return match.group(1), matches
 
-def extract_client_id(url):
-	r = session.get(url)
+def get(url):
+	r = session.get(url, timeout=(10, 60))
 	r.raise_for_status()
-	match = re.search(r'client_id=([a-zA-Z\d]{32})', r.text)
-	return match
+	return r.text
 
 def main():
-	app_ver, urls = extract_src_urls()
-	for url in urls:
-		match = extract_client_id(url)
-		if match == None:
-			continue
-		write_id(app_ver, match.group(1))
+	# sc-dl.py finds and refreshes the ID on its own; this just forces a lookup.
+	app_ver, client_id = find_client_id(get)
+	write_client_id(app_ver, client_id)
 	print('OK.')
 
 if __name__ == '__main__':
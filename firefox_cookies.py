@@ -1,8 +1,11 @@
 import os
+import sys
 import sqlite3
 import traceback
 
 
+HOSTS = ('.soundcloud.com', 'api-auth.soundcloud.com', 'soundcloud.com')
+
 def get_folder_name(profiles_path):
 	paths = []
 	for fname in os.listdir(profiles_path):
@@ -18,10 +21,9 @@ def get_cookies(path):
 	conn = sqlite3.connect(path)
 	cursor = conn.cursor()
 	try:
-		cursor.execute('SELECT host, name, value FROM moz_cookies')
-		for host, name, value in cursor.fetchall():
-			if host in ('.soundcloud.com', 'api-auth.soundcloud.com', 'soundcloud.com'):
-				parsed[name] = value
+		cursor.execute('SELECT name, value FROM moz_cookies WHERE host IN (?, ?, ?)', HOSTS)
+		for name, value in cursor:
+			parsed[name] = value
 	finally:
 		conn.close()
 	if not parsed:
@@ -40,6 +42,14 @@ def write_cookies(parsed):
 		for k, v in parsed.items():
 			f.write('{}\t{}\n'.format(k, v))
 
+def get_path():
+	profiles_path = os.path.join(os.getenv('appdata'), 'Mozilla', 'Firefox', 'profiles')
+	folder_name = get_folder_name(profiles_path)
+	return os.path.join(profiles_path, folder_name, 'cookies.sqlite')
+
+def read_cookies():
+	return get_cookies(get_path())
+
 def main(cookies_path):
 	while True:
 		parsed = get_cookies(cookies_path)
@@ -53,11 +63,8 @@ def main(cookies_path):
 	print('OK.')
 
 if __name__ == '__main__':
-	profiles_path = os.path.join(os.getenv('appdata'), 'Mozilla', 'Firefox', 'profiles')
-	folder_name = get_folder_name(profiles_path)
-	path = os.path.join(profiles_path, folder_name, 'cookies.sqlite')
 	try:
-		main(path)
+		main(get_path())
 	except Exception:
 		traceback.print_exc()
 	finally:
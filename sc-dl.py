@@ -1,28 +1,37 @@
+import io
 import os
 import re
 import sys
 import json
+import errno
+import time
+import functools
 import base64
+import hashlib
 import argparse
+import itertools
 import platform
 import traceback
+import threading
 import subprocess
+from urllib.parse import urlparse, parse_qs
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
-import m3u8
-import mutagen
 import requests
 from tqdm import tqdm
-from mutagen import id3
-from mutagen.flac import Picture
-from mutagen.oggopus import OggOpus
-from mutagen.mp4 import MP4, MP4Cover
-from mutagen.id3 import ID3NoHeaderError
 
 from api import client
+from api.cache import Cache
+from api.ratelimit import BandwidthGovernor
+from utils.archive import Archive
+from utils.jobqueue import JobQueue
+from utils.pipeline import Batch, Pipeline
+from utils.stats import Stats, Profiler
 
 
 def err(msg):
-	print(msg)
+	tqdm.write(msg)
 	traceback.print_exc()
 
 def parse_cfg():
@@ -40,33 +49,65 @@ def parse_cookies():
 		parsed[split_line[-2]] = split_line[-1].rstrip('\n').replace('&amp;', '&').replace('&quot;', '"')
 	return parsed
 
+def load_cookies():
+	# The dumpers are only imported when asked for; Chrome's needs pywin32.
+	if cfg['cookies_from'] == 'chrome':
+		import chrome_cookies
+		return chrome_cookies.read_cookies()
+	if cfg['cookies_from'] == 'firefox':
+		import firefox_cookies
+		return firefox_cookies.read_cookies()
+	return parse_cookies()
+
 def dir_setup(path):
 	if not os.path.isdir(path):
 		os.makedirs(path)
 
 def read_txt(path):
+	# Read line by line, as lists can run to hundreds of thousands of URLs.
 	with open(path) as f:
-		return [u.strip() for u in f.readlines() if u.strip()]
+		for line in f:
+			line = line.strip()
+			if line:
+				yield line
+
+def canonicalize(url):
+	# Fragments, share/tracking params, www/mobile hosts, http and trailing slashes
+	# all still point at the same item. Only ?in= changes what's fetched.
+	parsed = urlparse(url)
+	host = parsed.netloc.lower()
+	if host in ('www.soundcloud.com', 'm.soundcloud.com'):
+		host = 'soundcloud.com'
+	query = ''
+	in_set = parse_qs(parsed.query).get('in')
+	if in_set:
+		query = '?in=' + in_set[0]
+	return 'https://' + host + parsed.path.rstrip('/') + query
 
 def process_urls(urls):
-	processed = []
-	fix = lambda x: x.split('#')[0]
+	# A generator, so huge lists are classified and fetched as they're read.
+	# Dicts as sets, since set() here is the set handler.
+	seen = {}
 	for url in urls:
-		if url.endswith('.txt'):
-			for txt_url in read_txt(url):
-				if txt_url not in processed:
-					processed.append(fix(txt_url))
+		if not url.endswith('.txt'):
+			lines = [url]
+		elif url in seen:
+			continue
 		else:
-			if url not in processed:
-				processed.append(fix(url))
-	return processed
+			seen[url] = True
+			lines = read_txt(url)
+		for line in lines:
+			canonical = canonicalize(line)
+			if not canonical in seen:
+				seen[canonical] = True
+				yield canonical
 
 def parse_prefs():
 	cfg = parse_cfg()
 	parser = argparse.ArgumentParser()
 	parser.add_argument(
 		'-u', '--urls', 
-		nargs='+', required=True,
+		nargs='+', default=[],
 		help='Multiple links or text file filenames / paths.'
 	)
 	parser.add_argument(
@@ -90,23 +131,90 @@ def parse_prefs():
 		action='store_true', default=cfg['keep_cover'],
 		help='Keep cover in album folder.'
 	)
+	parser.add_argument(
+		'-w', '--segment-workers',
+		default=cfg['segment_workers'], type=int,
+		help='Number of HLS segments to download concurrently.'
+	)
+	parser.add_argument(
+		'-j', '--track-workers',
+		default=cfg['track_workers'], type=int,
+		help='Number of tracks to download concurrently.'
+	)
+	parser.add_argument(
+		'-l', '--bandwidth-limit',
+		type=float, metavar='MB',
+		help='Cap total download speed to MB/s across all transfers, ignoring the schedule.'
+	)
+	parser.add_argument(
+		'--watch',
+		default=cfg['watch_interval'], type=int, metavar='SECS',
+		help='Keep running and re-sync the URLs every SECS seconds.'
+	)
+	parser.add_argument(
+		'--cookies-from',
+		choices=['chrome', 'firefox'], default=cfg['cookies_from'] or None,
+		help='Read the SoundCloud cookies straight from this browser instead of cookies.txt.'
+	)
+	parser.add_argument(
+		'--queue',
+		default=cfg['queue_path'] or None,
+		help='Add the URLs to this shared job queue, then work through it with any other workers.'
+	)
+	parser.add_argument(
+		'--import-archive',
+		nargs='+', default=[],
+		help='Add already downloaded tracks in these folders to the download archive.'
+	)
+	parser.add_argument(
+		'-r', '--refresh',
+		action='store_true',
+		help='Ignore cached API responses (fresh ones are still cached).'
+	)
+	parser.add_argument(
+		'--stage-stats',
+		action='store_true',
+		help='Periodically print pipeline stage queue depths.'
+	)
+	parser.add_argument(
+		'--report',
+		help='Write a timing and traffic report for the run to this path (.json or .csv).'
+	)
+	parser.add_argument(
+		'--live-stats',
+		action='store_true',
+		help='Periodically print timing and traffic stats.'
+	)
+	parser.add_argument(
+		'--profile',
+		help='Profile the run to this path (.prof for cProfile, .html for pyinstrument).'
+	)
+	parser.add_argument(
+		'--pool-stats',
+		action='store_true',
+		help='Print HTTP connection pool stats when done.'
+	)
 	args = vars(parser.parse_args())
+	if not args['urls'] and not args['import_archive'] and not args['queue']:
+		parser.error('the following arguments are required: -u/--urls')
 	cfg.update(args)
-	cfg['urls'] = process_urls(cfg['urls'])
 	return cfg
 
+# One pass over the URL, with the group name as the media type. Alternatives are tried in
+# order, so sets, likes, albums and tracks win over the catch-all track pattern.
+URL_PATTERN = re.compile(
+	r'^https://soundcloud\.com/(?:'
+	r'(?P<set>[\w-]+/sets/[\w-]+)|'
+	r'(?P<likes>you/likes)|'
+	r'(?P<albums>[\w-]+/albums)|'
+	r'(?P<tracks>[\w-]+/tracks)|'
+	r'(?P<track>[\w-]+/[\w-]+(?:\?in=[\w-]+/sets/[\w-]+)?)'
+	r')$')
+
 def check_url(url):
-	media_types = [
-		(r'^https://soundcloud.com/[\w-]+/sets/[\w-]+$', 'set'),
-		(r'^https://soundcloud.com/you/likes$', 'likes'),
-		(r'^https://soundcloud.com/[\w-]+/albums$', 'albums'),
-		(r'^https://soundcloud.com/[\w-]+/tracks$', 'tracks'),
-		(r'^https://soundcloud.com/[\w-]+/[\w-]+$', 'track'),
-		(r'^https://soundcloud.com/[\w-]+/[\w-]+\?in=[\w-]+/sets/[\w-]+$', 'track')
-	]
-	for media_type in media_types:
-		if re.match(media_type[0], url) != None:
-			return media_type[1]
+	match = URL_PATTERN.match(url)
+	if match != None:
+		return match.lastgroup
 
 def sanitize(fname):
 	if is_win:
@@ -118,7 +226,7 @@ def parse_template(meta, unparsed, default):
 	try:
 		parsed = unparsed.format(**meta)
 	except KeyError:
-		print('Failed to parse template. Default one will be used instead.')
+		tqdm.write('Failed to parse template. Default one will be used instead.')
 		parsed = default.format(**meta)
 	return sanitize(parsed)
 
@@ -130,6 +238,7 @@ def parse_meta(src, meta=None, num=None, total=None, url=None):
 		meta['artist'] = src['user']['username']
 		meta['title'] =	 src.get('title')
 		meta['tracknumber'] = num
+		meta['soundcloud_id'] = src['id']
 		meta['trackpadded'] = str(num).zfill(len(str(meta['tracktotal'])))
 		meta['year'] = year
 		if src.get('publisher_metadata') != None:
@@ -164,7 +273,7 @@ def query_quals(meta):
 	if want == 4:
 		if meta['downloadable'] == True and meta['has_downloads_left'] == True:
 			key = 'download'
-			specs[key].extend(client.get_file(specs[key][0]))			
+			specs[key].extend(client.get_file(meta['id']))			
 		elif len(specs['audio/mp4']) == 3:
 			key = 'audio/mp4'
 		else:
@@ -181,95 +290,403 @@ def query_quals(meta):
 			key = 'audio/ogg'
 		else:
 			raise Exception('Unavailable in OPUS.')
-	return specs[key]
+	return key, specs[key]
+
+def get_seg(url):
+	# Retries and backoff are handled by the client's cdn policy.
+	with conns, stats.timed('segment'):
+		r = client.fetch(url, headers={'Range': 'bytes=0-'}, stream=True)
+		return b''.join(iter_body(r, url))
+
+def read_journal(path):
+	journal_path = path + '.journal'
+	if cfg['resume'] == False or not os.path.isfile(journal_path) or not os.path.isfile(path):
+		return {}
+	try:
+		with open(journal_path) as f:
+			journal = json.load(f)
+	except ValueError:
+		return {}
+	# Only trust it if everything it vouches for actually made it to disk.
+	if journal.get('offset', 0) > os.path.getsize(path):
+		return {}
+	return journal
+
+def write_journal(path, journal):
+	with open(path + '.journal.tmp', 'w') as f:
+		json.dump(journal, f)
+	os.replace(path + '.journal.tmp', path + '.journal')
+
+def remove_journal(path):
+	if os.path.isfile(path + '.journal'):
+		os.remove(path + '.journal')
+
+def sync(f):
+	f.flush()
+	os.fsync(f.fileno())
+
+def sync_path(path):
+	with open(path, 'r+b') as f:
+		os.fsync(f.fileno())
+
+def preallocate(f, length):
+	# Reserves the space up front, so a full disk fails the track before the transfer.
+	if cfg['preallocate'] == False or length <= 0:
+		return
+	if not hasattr(os, 'posix_fallocate'):
+		f.truncate(length)
+		return
+	try:
+		os.posix_fallocate(f.fileno(), 0, length)
+	except OSError as e:
+		# Some network filesystems don't support it.
+		if e.errno == errno.ENOSPC:
+			raise
 
-def download_seg(url, path):
+def discard_partial(path):
+	if path == None or not os.path.isfile(path):
+		return
+	# Partial downloads with a journal are kept so the next run can resume them.
+	if cfg['resume'] == True and os.path.isfile(path + '.journal'):
+		return
+	os.remove(path)
+
+def open_seg_sink(path, ext, tmp_path, total, header=b''):
+	# MP3 and Opus segments concatenate into a valid file as is. AAC comes as fMP4 with the
+	# init segment first, so ffmpeg can remux it straight off the pipe while we download.
+	# A pipe can't be resumed, so resuming AAC through a temp file is opt-in.
+	resume_aac = cfg['resume'] == True and cfg['resume_aac'] == True
+	if cfg['stream_segments'] == True and ext == '.m4a' and resume_aac == False:
+		proc = subprocess.Popen(
+			['ffmpeg', '-loglevel', 'error', '-y', '-i', 'pipe:0', '-c:a', 'copy', '-f', 'mp4', path],
+			stdin=subprocess.PIPE)
+		return proc.stdin, proc, None, 0
+	if cfg['stream_segments'] == True and ext != '.m4a':
+		sink_path = path
+	else:
+		sink_path = tmp_path
+	journal = read_journal(sink_path)
+	if journal.get('total') == total:
+		f = open(sink_path, 'r+b')
+		f.truncate(journal['offset'])
+		f.seek(journal['offset'])
+		return f, None, sink_path, journal['segments']
+	f = open(sink_path, 'wb')
+	f.write(header)
+	return f, None, sink_path, 0
+
+def get_segments(url):
 	segments = []
-	manifest = client.get_manifest(url)
+	with stats.timed('manifest'):
+		manifest = client.get_manifest(url)
+	# Format modules are imported on first use, as they're a large part of startup.
+	import m3u8
 	parsed = m3u8.loads(manifest)
 	if parsed.segment_map != None:
 		segments = [parsed.segment_map['uri']]
 	segments.extend(x.uri for x in parsed.segments)
-	out_path = os.path.join('sc-dl_tmp', 'tmp.mp4')
-	with tqdm(total=len(segments), 
+	return segments
+
+def get_expiry(url):
+	# Signed CDN URLs carry their expiry either as Expires or inside a CloudFront policy.
+	query = parse_qs(urlparse(url).query)
+	try:
+		if 'Expires' in query:
+			return int(query['Expires'][0])
+		if 'Policy' in query:
+			policy = query['Policy'][0].replace('-', '+').replace('_', '=').replace('~', '/')
+			policy = json.loads(base64.b64decode(policy))
+			return int(policy['Statement'][0]['Condition']['DateLessThan']['AWS:EpochTime'])
+	except (ValueError, KeyError, IndexError, TypeError):
+		pass
+	return None
+
+def get_segments_expiry(segments):
+	expiries = [x for x in map(get_expiry, segments) if x != None]
+	return min(expiries) if expiries else None
+
+def remux(in_path, out_path, ext):
+	# The output ends in .part, so ffmpeg can't guess the format from it.
+	with stats.timed('ffmpeg'):
+		code = subprocess.run([
+			'ffmpeg', '-loglevel', 'error', '-y', '-i', in_path, '-c:a', 'copy',
+			'-f', FFMPEG_FORMATS[ext], out_path]).returncode
+	# The download is kept, so the remux can be retried without fetching it again.
+	if code != 0:
+		raise Exception('ffmpeg failed to remux track.')
+	remove_journal(in_path)
+	os.remove(in_path)
+
+def download_seg(segments, path, ext, tmp_path, header=b'', pos=0, resign=None):
+	total = len(segments)
+	resign_lock = threading.Lock()
+
+	def fetch(n):
+		url = segments[n]
+		try:
+			return get_seg(url)
+		except requests.HTTPError as e:
+			if resign == None or e.response.status_code != 403:
+				raise
+		with resign_lock:
+			# Other workers will have hit the same expiry, so only the first re-signs.
+			if segments[n] == url:
+				tqdm.write('Segment URLs expired, refreshing manifest.')
+				fresh = resign()
+				if len(fresh) != total:
+					raise Exception('Refreshed manifest has a different segment count.')
+				segments[:] = fresh
+		return get_seg(segments[n])
+
+	f, proc, sink_path, done = open_seg_sink(path, ext, tmp_path, total, header=header)
+	fsync_bytes = cfg['fsync_mb'] * 1024 * 1024
+	synced = 0 if proc != None else f.tell()
+	with tqdm(total=total, initial=done, position=pos, leave=False,
 		bar_format='{l_bar}{bar}{n_fmt}/{total_fmt} segments [{elapsed}<{remaining}]') as bar:
 				   
-		with open(out_path, 'wb') as f:
-			for url in segments:
-				r = requests.get(url, headers={'Range': 'bytes=0-'}, stream=True)
-				r.raise_for_status()
-				for chunk in r.iter_content(32*1024):
-					if chunk:
-						f.write(chunk)
+		# Only a window of segments is fetched ahead of the one being written, so a slow
+		# segment can't leave the rest of a long set piling up in memory behind it.
+		window = max(cfg['segment_workers'], 1) * 2
+		pending = deque()
+		queued = done
+		pool = ThreadPoolExecutor(max_workers=cfg['segment_workers'])
+		try:
+			while done < total:
+				while queued < total and len(pending) < window:
+					pending.append(pool.submit(fetch, queued))
+					queued += 1
+				# Taken in submission order, so segments land in manifest order.
+				seg = pending.popleft().result()
+				f.write(seg)
+				done += 1
+				# Only vouch for what's been synced, and sync in batches rather than per segment.
+				if sink_path != None and f.tell() - synced >= fsync_bytes:
+					sync(f)
+					synced = f.tell()
+					if cfg['resume'] == True:
+						write_journal(sink_path, {'total': total, 'segments': done, 'offset': synced})
 				bar.update(1)
-	subprocess.run(['ffmpeg', '-loglevel', 'error', '-y', '-i', out_path, '-c:a', 'copy', path])
-
-def download(url, path):
-	out_path = os.path.join('sc-dl_tmp', 'tmp.mp4')
-	r = requests.get(url, headers={'Range': 'bytes=0-'}, stream=True)
-	r.raise_for_status()
-	with tqdm(total=int(r.headers['Content-Length']), unit='B', unit_scale=True,
-		unit_divisor=1024) as bar:
-		with open(out_path, 'wb') as f:
-			for chunk in r.iter_content(32*1024):
-				if chunk:
-					f.write(chunk)
-					bar.update(len(chunk))
-
-def write_tags(meta, path, ext, cov_path):
-	if cov_path != None:
-		with open(cov_path, 'rb') as f:
-			cov_data = f.read()
+			if sink_path != None:
+				sync(f)
+		except Exception:
+			if proc != None:
+				# Reaped, so ffmpeg lets go of the .part file before it's cleaned up.
+				proc.kill()
+				proc.wait()
+			raise
+		finally:
+			# Segments queued behind a failure aren't wanted.
+			pool.shutdown(cancel_futures=True)
+			f.close()
+	if proc != None:
+		with stats.timed('ffmpeg'):
+			code = proc.wait()
+		if code != 0:
+			raise Exception('ffmpeg failed to remux track.')
+		return False
+	if sink_path == tmp_path and cfg['resume'] == True:
+		# Vouches for the whole file until the remux succeeds, so a failed remux
+		# is retried on the next run without downloading the track again.
+		write_journal(sink_path, {'total': total, 'segments': total, 'offset': os.path.getsize(sink_path)})
+	else:
+		remove_journal(sink_path)
+	# Left to the caller, so the remux can run off the download workers.
+	return sink_path == tmp_path
+
+def iter_body(r, url):
+	# Everything pulled off the CDN goes through here, so the bandwidth cap is global.
+	host = urlparse(url).netloc
+	for chunk in r.iter_content(32*1024):
+		if chunk:
+			bandwidth.consume(len(chunk))
+			stats.add_bytes(host, len(chunk))
+			yield chunk
+
+def download(url, path, pos=0):
+	journal = read_journal(path)
+	offset = journal.get('offset', 0)
+	if offset and offset >= journal.get('length', 0):
+		remove_journal(path)
+		return
+	chunk_bytes = cfg['chunk_threshold_mb'] * 1024 * 1024
+	with conns:
+		r = client.fetch(url, headers={'Range': 'bytes={}-'.format(offset)}, stream=True)
+		if r.status_code == 206:
+			length = int(r.headers['Content-Range'].split('/')[-1])
+		else:
+			length = int(r.headers['Content-Length'])
+		if offset and (r.status_code != 206 or journal.get('length') != length):
+			# The server ignored the range or the file changed, so start over.
+			r.close()
+			offset = 0
+			r = client.fetch(url, headers={'Range': 'bytes=0-'}, stream=True)
+			length = int(r.headers['Content-Length'])
+		chunked = (r.status_code == 206 and offset == 0 and cfg['chunk_workers'] > 1
+			and length >= chunk_bytes > 0)
+		if chunked == False:
+			download_stream(r, url, path, offset, length, pos)
+		else:
+			r.close()
+	if chunked == True:
+		chunks = journal.get('chunks') if journal.get('length') == length else None
+		download_chunked(url, path, length, chunks, pos)
+	remove_journal(path)
+
+def download_stream(r, url, path, offset, length, pos):
+	if offset:
+		f = open(path, 'r+b')
+		f.seek(offset)
+	else:
+		f = open(path, 'wb')
+		preallocate(f, length)
+		if cfg['resume'] == True:
+			write_journal(path, {'length': length, 'offset': 0})
+	fsync_bytes = cfg['fsync_mb'] * 1024 * 1024
+	synced = offset
+	with tqdm(total=length, initial=offset, unit='B', unit_scale=True,
+		unit_divisor=1024, position=pos, leave=False) as bar:
+		with f:
+			for chunk in iter_body(r, url):
+				f.write(chunk)
+				bar.update(len(chunk))
+				if f.tell() - synced >= fsync_bytes:
+					sync(f)
+					synced = f.tell()
+					if cfg['resume'] == True:
+						write_journal(path, {'length': length, 'offset': synced})
+			if f.tell() != length:
+				raise Exception('Download ended early.')
+			sync(f)
+
+def download_chunked(url, path, length, chunks, pos):
+	# Large files come down as parallel ranges, each writing at its own offset. The journal
+	# only marks whole chunks done, so a resumed chunk restarts from its beginning.
+	size = cfg['chunk_mb'] * 1024 * 1024
+	if chunks == None:
+		chunks = [[start, min(start+size, length), False] for start in range(0, length, size)]
+		with open(path, 'wb') as f:
+			preallocate(f, length)
+			f.truncate(length)
+	lock = threading.Lock()
+
+	def fetch_chunk(n):
+		start, end, done = chunks[n]
+		if done == True:
+			return
+		with conns:
+			r = client.fetch(
+				url, headers={'Range': 'bytes={}-{}'.format(start, end-1)}, stream=True)
+			if r.status_code != 206:
+				r.close()
+				raise Exception('Server ignored the range request.')
+			with open(path, 'r+b') as f:
+				f.seek(start)
+				for data in iter_body(r, url):
+					f.write(data)
+					bar.update(len(data))
+				if f.tell() != end:
+					raise Exception('Chunk ended early.')
+				sync(f)
+		with lock:
+			chunks[n][2] = True
+			if cfg['resume'] == True:
+				write_journal(path, {'length': length, 'chunks': chunks})
+
+	done = sum(end - start for start, end, finished in chunks if finished == True)
+	with tqdm(total=length, initial=done, unit='B', unit_scale=True,
+		unit_divisor=1024, position=pos, leave=False) as bar:
+		with ThreadPoolExecutor(max_workers=cfg['chunk_workers']) as pool:
+			list(pool.map(fetch_chunk, range(len(chunks))))
+
+# Archived under the format actually delivered, ranked like -q, with 4 for download
+# button files, so a track archived at one rank counts for any request it satisfies.
+QUALITY_RANKS = {
+	'.ogg': 1,
+	'.mp3': 2,
+	'.m4a': 3
+}
+
+FFMPEG_FORMATS = {
+	'.m4a': 'mp4',
+	'.mp3': 'mp3',
+	'.ogg': 'ogg'
+}
+MP4_ID_KEY = '----:com.apple.iTunes:SOUNDCLOUD_ID'
+MP4_TAGS = [
+	('\xa9alb', 'album'),
+	('aART', 'albumartist'),
+	('\xa9ART', 'artist'),
+	('\xa9cmt', 'comment'),
+	('\xa9gen', 'genre'),
+	('\xa9nam', 'title'),
+	('\xa9day', 'year')
+]
+ID3_TAGS = {
+	'album': 'TALB',
+	'albumartist': 'TPE2',
+	'artist': 'TPE1',
+	'comment': 'COMM',
+	'copyright': 'TCOP',
+	'isrc': 'TSRC',
+	'label': 'TPUB',
+	'title': 'TIT2',
+	'year': 'TYER'
+}
+
+def make_id3(meta, cov_data, audio=None):
+	from mutagen import id3
+	if audio == None:
+		audio = id3.ID3()
+	audio['TRCK'] = id3.TRCK(
+		encoding=3, text="{}/{}".format(meta['tracknumber'], meta['tracktotal'])
+	)
+	for k, v in meta.items():
+		id3tag = ID3_TAGS.get(k)
+		if v and id3tag:
+			audio[id3tag] = getattr(id3, id3tag)(encoding=3, text=v)
+	audio.add(id3.TXXX(encoding=3, desc='SOUNDCLOUD_ID', text=str(meta['soundcloud_id'])))
+	if cov_data != None:
+		audio.add(id3.APIC(3, 'image/jpeg', 3, None, cov_data))
+	return audio
+
+def render_id3(meta, cov_data):
+	# Written ahead of the first segment, so streamed MP3s never need a second pass.
+	f = io.BytesIO()
+	make_id3(meta, cov_data).save(f, padding=lambda info: 1024)
+	return f.getvalue()
+
+def write_tags(meta, path, ext, cov_data):
 	if ext == '.m4a':
-		t = [
-			('\xa9alb', 'album'),
-			('aART', 'albumartist'),
-			('\xa9ART', 'artist'),
-			('\xa9cmt', 'comment'),
-			('\xa9gen', 'genre'),
-			('\xa9nam', 'title'),
-			('\xa9day', 'year')
-		]
+		from mutagen.mp4 import MP4, MP4Cover, MP4FreeForm
 		audio = MP4(path)
-		audio.delete()
-		for frame, key in t:
+		# Cleared in memory rather than with delete(), which would save the file an extra time.
+		if audio.tags == None:
+			audio.add_tags()
+		else:
+			audio.tags.clear()
+		for frame, key in MP4_TAGS:
 			if meta.get(key):
 				audio[frame] = meta[key]
 		audio['trkn'] = [(meta['tracknumber'], meta['tracktotal'])]
-		if cov_path != None:
+		audio[MP4_ID_KEY] = [MP4FreeForm(str(meta['soundcloud_id']).encode('ascii'))]
+		if cov_data != None:
 			audio['covr'] = [MP4Cover(cov_data, imageformat=MP4Cover.FORMAT_JPEG)]
 	if ext == '.mp3':
+		from mutagen import id3
 		try: 
 			audio = id3.ID3(path)
-		except ID3NoHeaderError:
+		except id3.ID3NoHeaderError:
 			audio = id3.ID3()
-		audio['TRCK'] = id3.TRCK(
-			encoding=3, text="{}/{}".format(meta['tracknumber'], meta['tracktotal'])
-		)
-		legend={
-			'album': id3.TALB,
-			'albumartist': id3.TPE2,
-			'artist': id3.TPE1,
-			'comment': id3.COMM,
-			'copyright': id3.TCOP,
-			'isrc': id3.TSRC,
-			'label': id3.TPUB,
-			'title': id3.TIT2,
-			'year': id3.TYER
-		}
-		for k, v in meta.items():
-			id3tag = legend.get(k)
-			if v and id3tag:
-				audio[id3tag.__name__] = id3tag(encoding=3, text=v)
-		if cov_path != None:
-			audio.add(id3.APIC(3, 'image/jpeg', 3, None, cov_data))
+		make_id3(meta, cov_data, audio=audio)
 	elif ext == '.ogg':
+		from mutagen.flac import Picture
+		from mutagen.oggopus import OggOpus
 		audio = OggOpus(path)
 		del meta['trackpadded']
 		for k, v in meta.items():
 			if v:
 				audio.tags[k] = str(v)
-		if cov_path != None:
+		if cov_data != None:
 			picture = Picture()
 			picture.data = cov_data
 			picture.type = 17
@@ -283,73 +700,336 @@ def write_tags(meta, path, ext, cov_path):
 			audio['metadata_block_picture'] = [vcomment_value]
 	audio.save(path)
 
-def write_cover(path, url):
-	cov_path = os.path.join(path, 'cover.jpg')
+def read_id_tag(path):
+	# (track ID, comment, track number, title), whichever of them the file has.
+	import mutagen
+	from mutagen import id3
+	from mutagen.mp4 import MP4
+	track_id = comment = num = title = None
+	audio = mutagen.File(path)
+	if audio == None or audio.tags == None:
+		return track_id, comment, num, title
+	if isinstance(audio, MP4):
+		if MP4_ID_KEY in audio.tags:
+			track_id = bytes(audio.tags[MP4_ID_KEY][0]).decode('ascii')
+		if '\xa9cmt' in audio.tags:
+			comment = audio.tags['\xa9cmt'][0]
+		if 'trkn' in audio.tags:
+			num = audio.tags['trkn'][0][0]
+		if '\xa9nam' in audio.tags:
+			title = audio.tags['\xa9nam'][0]
+	elif isinstance(audio.tags, id3.ID3):
+		if 'TXXX:SOUNDCLOUD_ID' in audio.tags:
+			track_id = audio.tags['TXXX:SOUNDCLOUD_ID'].text[0]
+		comments = audio.tags.getall('COMM')
+		if comments:
+			comment = comments[0].text[0]
+		if 'TRCK' in audio.tags:
+			num = audio.tags['TRCK'].text[0]
+		if 'TIT2' in audio.tags:
+			title = audio.tags['TIT2'].text[0]
+	else:
+		track_id = audio.tags.get('soundcloud_id', [None])[0]
+		comment = audio.tags.get('comment', [None])[0]
+		num = audio.tags.get('tracknumber', [None])[0]
+		title = audio.tags.get('title', [None])[0]
+	# "3/12" in ID3, and a plain string in Vorbis comments.
+	try:
+		num = int(str(num).split('/')[0])
+	except ValueError:
+		num = None
+	return track_id, comment, num, title
+
+def get_set_tracks(url, sets):
+	# A set's tracks in order, with the stubs filled in so they all have titles.
+	tracks = sets.get(url)
+	if tracks == None:
+		tracks = client.get_metadata(url)['tracks']
+		stubs = [t['id'] for t in tracks if not 'title' in t]
+		if stubs:
+			hydrated = client.get_tracks(stubs)
+			tracks = [hydrated.get(t['id'], t) for t in tracks]
+		sets[url] = tracks
+	return tracks
+
+def match_set_track(tracks, num, title):
+	# The title still matches if the set's been reordered since the download; the
+	# track number is the fallback for retitled tracks.
+	if title:
+		for _track in tracks:
+			if _track.get('title') == title:
+				return _track['id']
+	if num != None and 1 <= num <= len(tracks):
+		return tracks[num-1]['id']
+	return None
+
+def import_archive(paths):
+	before = len(archive)
+	# Set URL -> its tracks, as most files in a folder share the same set.
+	sets = {}
+	for root_path in paths:
+		for root, _, fnames in os.walk(root_path):
+			for fname in fnames:
+				ext = os.path.splitext(fname)[1].lower()
+				if not ext in QUALITY_RANKS:
+					continue
+				path = os.path.join(root, fname)
+				try:
+					track_id, comment, num, title = read_id_tag(path)
+					# Files from before the ID tag was written only have a permalink in the
+					# comment: the track's own for single tracks, and the set's otherwise.
+					if track_id == None and comment:
+						media_type = check_url(comment)
+						if media_type == 'track':
+							track_id = client.get_metadata(comment)['id']
+						elif media_type == 'set':
+							track_id = match_set_track(get_set_tracks(comment, sets), num, title)
+				except Exception:
+					err('Failed to read tags: ' + path)
+					continue
+				if track_id != None:
+					archive.add(track_id, QUALITY_RANKS[ext], path)
+	print('Imported {} tracks into the download archive.'.format(len(archive) - before))
+
+def get_cover(url):
 	url = url[:-9] + 't500x500.jpg'
-	r = requests.get(url)
-	r.raise_for_status()
-	with open(cov_path, 'wb') as f:
-		f.write(r.content)
-	return cov_path
+	with covers_lock:
+		if url in covers:
+			covers.move_to_end(url)
+			return covers[url]
+	key = hashlib.sha1(url.encode('UTF-8')).hexdigest()
+	cov_path = os.path.join(cfg['cover_cache_path'], key[:2], key + '.jpg')
+	if os.path.isfile(cov_path):
+		with open(cov_path, 'rb') as f:
+			cov_data = f.read()
+	else:
+		cov_data = client.fetch(url).content
+		dir_setup(os.path.dirname(cov_path))
+		with open(cov_path + '.tmp', 'wb') as f:
+			f.write(cov_data)
+		os.replace(cov_path + '.tmp', cov_path)
+	with covers_lock:
+		covers[url] = cov_data
+		while len(covers) > cfg['cover_cache_size']:
+			covers.popitem(last=False)
+	return cov_data
 
-def is_downloadable(track):
+def write_cover(path, url):
+	cov_data = get_cover(url)
+	if cfg['keep_cover'] == True:
+		with open(os.path.join(path, 'cover.jpg'), 'wb') as f:
+			f.write(cov_data)
+	return cov_data
+
+def wait_cover(cov_future):
+	if cov_future == None:
+		return None
+	try:
+		return cov_future.result()
+	except Exception:
+		tqdm.write('Failed to write cover.')
+
+def unavailable_reason(track):
 	if track['streamable'] == False:
-		print('Track is not streamable.')
-		return False
+		return 'Track is not streamable.'
 	elif track['monetization_model'] == 'SUB_HIGH_TIER' and is_go_plus == False:
-		print('Track requires an active Go+ subscription.')
-		return False
+		return 'Track requires an active Go+ subscription.'
 	elif track['policy'] == 'BLOCK':
-		print('Track unavailable in your region.')
+		return 'Track unavailable in your region.'
+	return None
+
+def is_downloadable(track):
+	if not 'media' in track:
+		tqdm.write('Track metadata unavailable.')
+		return False
+	reason = unavailable_reason(track)
+	if reason != None:
+		tqdm.write(reason)
 		return False
 	return True
 
-def get_additional_meta(_url):
+def get_set_index(url):
+	with set_indexes_lock:
+		index = set_indexes.get(url)
+		if index == None:
+			# Built once per set, as URL lists often hold many tracks from the same one.
+			meta = client.get_metadata(url)['tracks']
+			total = len(meta)
+			index = {}
+			for num, _track in enumerate(meta, 1):
+				index[_track['id']] = (num, total)
+				if _track.get('permalink_url') != None:
+					index[_track['permalink_url']] = (num, total)
+			set_indexes[url] = index
+	return index
+
+def get_additional_meta(_url, track_id=None):
 	split = _url.split('?in=')
-	url = 'https://soundcloud.com/' + split[-1]
-	meta = client.get_metadata(url)['tracks']
-	total = len(meta)
-	for num, _track in enumerate(meta, 1):
-		if _track.get('permalink_url') == split[0]:
-			return num, total	
+	index = get_set_index('https://soundcloud.com/' + split[-1])
+	# Stubs in set payloads only have an ID, so try that before the permalink.
+	return index.get(track_id) or index.get(split[0])
+
+def resolve_stage(job, worker):
+	track, parsed_meta, path = job['track'], job['meta'], job['path']
+	key, specs = query_quals(track)
+	template = parse_template(parsed_meta, cfg['template'], '{trackpadded}. {title}')
+	job['specs'] = specs
+	job['is_dload'] = key == 'download'
+	# Keyed by track ID, as several jobs can share a folder and track number (likes).
+	# Written next to the final file, so the rename at the end is atomic and never copies.
+	job['out_path'] = os.path.join(path, str(track['id'])) + specs[1] + '.part'
+	job['tmp_path'] = os.path.join(path, str(track['id'])) + '.seg.part'
+	job['post_path'] = os.path.join(path, template) + specs[1]
+	if os.path.isfile(job['post_path']):
+		tqdm.write('Track already exists locally.')
+		archive_track(job, job['post_path'])
+		return None
+	return job
+
+def sign_stage(job, worker):
+	if job['is_dload'] == False:
+		job['segments'] = get_segments(job['specs'][2])
+		job['expires'] = get_segments_expiry(job['segments'])
+	return job
+
+def transfer_stage(job, worker):
+	specs, parsed_meta = job['specs'], job['meta']
+	desc = 'Downloading track {} of {}: {} - {}'.format(
+		job['num'], job['total'], parsed_meta['title'], specs[0])
+	job['remux'] = False
+	job['tagged'] = False
+	if job['is_dload'] == True:
+		tqdm.write(desc + ' (download button)')
+		download(specs[2], job['out_path'], pos=worker)
+	else:
+		tqdm.write(desc)
+		header = b''
+		if specs[1] == '.mp3' and cfg['stream_segments'] == True:
+			with stats.timed('tags'):
+				header = render_id3(job['meta'], wait_cover(job['cov_future']))
+			job['tagged'] = True
+		# Jobs can wait in the queue long enough for their signed URLs to run out.
+		if job['expires'] != None and job['expires'] - time.time() < cfg['resign_margin']:
+			job['segments'] = get_segments(specs[2])
+		job['remux'] = download_seg(
+			job['segments'], job['out_path'], specs[1], job['tmp_path'], header=header, pos=worker,
+			resign=lambda: get_segments(specs[2]))
+	return job
+
+def post_stage(job, worker):
+	post_path = job['post_path']
+	if job['remux'] == True:
+		remux(job['tmp_path'], job['out_path'], job['specs'][1])
+	if job['is_dload'] == False and job['tagged'] == False:
+		cov_data = wait_cover(job['cov_future'])
+		with stats.timed('tags'):
+			write_tags(job['meta'], job['out_path'], job['specs'][1], cov_data)
+	with stats.timed('rename'):
+		sync_path(job['out_path'])
+		try:
+			os.replace(job['out_path'], post_path)
+		except OSError:
+			tqdm.write('Failed to rename track.')
+			post_path = job['out_path'][:-len('.part')]
+			os.replace(job['out_path'], post_path)
+	archive_track(job, post_path)
+
+def stage_failed(stage, job):
+	err('Track failed ({}): {}'.format(stage, job['meta'].get('title')))
+	with track_failures_lock:
+		track_id = job['track']['id']
+		track_failures[track_id] = track_failures.get(track_id, 0) + 1
+	discard_partial(job.get('out_path'))
+	discard_partial(job.get('tmp_path'))
+
+# Rough kbps per format, to rank queued transfers by size. Download button files are
+# often lossless, so they're taken to be CD quality.
+TRANSFER_KBPS = {
+	'.ogg': 64,
+	'.mp3': 128,
+	'.m4a': 256,
+	'download': 1411
+}
+
+def transfer_priority(job):
+	track = job['track']
+	if cfg['transfer_priority'] == 'fresh':
+		# Newest uploads first; 2021-01-01T00:00:00Z -> -20210101000000.
+		return -int(re.sub(r'\D', '', track.get('created_at') or '')[:14] or 0)
+	kbps = TRANSFER_KBPS['download' if job['is_dload'] == True else job['specs'][1]]
+	return track.get('duration', 0) * kbps
+
+def make_pipeline():
+	workers = cfg['pipeline_workers']
+	size = cfg['pipeline_queue_size']
+	priority = None
+	if cfg['transfer_priority'] in ('small', 'fresh'):
+		priority = transfer_priority
+	return Pipeline([
+		('resolve', resolve_stage, workers['resolve'], size),
+		('sign', sign_stage, workers['sign'], size),
+		# Its input queue holds signed jobs, so its size is how many manifests are fetched ahead.
+		('transfer', transfer_stage, cfg['track_workers'], cfg['manifest_prefetch'], priority),
+		('post', post_stage, workers['post'], size)
+	], on_error=stage_failed)
+
+def archive_track(job, path):
+	if archive != None:
+		quality = 4 if job['is_dload'] == True else QUALITY_RANKS[job['specs'][1]]
+		archive.add(job['track']['id'], quality, path)
+
+def expected_quality(track):
+	# What query_quals would pick, short of looking up the download button. Stubs
+	# don't list their transcodings, so they have to match the requested quality.
+	want = cfg['quality']
+	if not 'media' in track:
+		return want
+	mimes = [
+		x['format']['mime_type'].split(';')[0] for x in track['media']['transcodings']
+		if x['format']['protocol'] == 'hls']
+	if want == 4 and track.get('downloadable') == True and track.get('has_downloads_left') == True:
+		return 4
+	if want >= 3 and 'audio/mp4' in mimes:
+		return 3
+	return min(want, 2)
+
+def is_archived(track):
+	return archive != None and archive.has(track['id'], expected_quality(track))
 
 def iter_track(meta, path, parsed_meta, num_oride=-1):
-	cov_path = None
-	out_path = os.path.join('sc-dl_tmp', 'tmp.mp4')
+	cov_future = None
 	total = len(meta)
 	for num, track in enumerate(meta, 1):
+		if is_archived(track):
+			tqdm.write('Track already in download archive.')
+			continue
 		if is_downloadable(track) == False:
 			continue
+		# Each job gets its own copy as parse_meta fills it in place.
 		if num_oride != -1:
-			parsed_meta = parse_meta(track, meta=parsed_meta, num=num_oride)
-		else:
-			parsed_meta = parse_meta(track, meta=parsed_meta, num=num)
-		specs = query_quals(track)
-		is_dload = specs[2].startswith('https://c')
-		if num == 1 and is_dload == False:
-			try:
-				cov_path = write_cover(path, meta[0]['artwork_url'])
-			except Exception:
-				print('Failed to write cover.')
-		template = parse_template(parsed_meta, cfg['template'], '{trackpadded}. {title}')
-		ffmpeg_out_path = os.path.join(path, str(num)) + specs[1]
-		post_path = os.path.join(path, template) + specs[1]
-		if os.path.isfile(post_path):
-			print('Track already exists locally.')
-			continue	
-		if is_dload == True:
-			print('Downloading track {} of {}: {} - {} (download button)'.format(num, total, parsed_meta['title'], specs[0]))
-			download(specs[2], ffmpeg_out_path)
+			track_meta = parse_meta(track, meta=dict(parsed_meta), num=num_oride)
 		else:
-			print('Downloading track {} of {}: {} - {}'.format(num, total, parsed_meta['title'], specs[0]))
-			download_seg(specs[2], ffmpeg_out_path)
-			write_tags(parsed_meta, ffmpeg_out_path, specs[1], cov_path)
-		try:
-			os.rename(ffmpeg_out_path, post_path)
-		except Exception:
-			print('Failed to rename track.')
-	if cov_path != None and cfg['keep_cover'] == False:
-		os.remove(cov_path)
+			track_meta = parse_meta(track, meta=dict(parsed_meta), num=num)
+		# Fetched once per album alongside the audio, and shared by all of its tracks.
+		if cov_future == None and meta[0].get('artwork_url') != None:
+			cov_future = cover_pool.submit(write_cover, path, meta[0]['artwork_url'])
+		# In queue mode, job_batch is the queue job these tracks belong to.
+		pipeline.put({
+			'track': track,
+			'meta': track_meta,
+			'path': path,
+			'num': num,
+			'total': total,
+			'cov_future': cov_future
+		}, batch=job_batch)
+
+def hydrate(tracks):
+	# Sets only come back with the first few tracks in full, the rest are ID-only stubs.
+	stubs = [t['id'] for t in tracks if not 'media' in t and not is_archived(t)]
+	if not stubs:
+		return tracks
+	hydrated = client.get_tracks(stubs)
+	return [hydrated.get(t['id'], t) for t in tracks]
 
 def set(meta, _, path=None):
 	parsed_meta = parse_meta(meta, total=len(meta['tracks']))
@@ -361,12 +1041,15 @@ def set(meta, _, path=None):
 	else:
 		album_path = os.path.join(cfg['output_path'], template)
 	dir_setup(album_path)
-	print(album_folder)
-	iter_track(meta['tracks'], album_path, parsed_meta)
+	tqdm.write(album_folder)
+	iter_track(hydrate(meta['tracks']), album_path, parsed_meta)
 
 def track(meta, url, path=None, num=1, total=1):
+	if is_archived(meta):
+		tqdm.write('Track already in download archive.')
+		return
 	if '?in=' in url:
-		num, total = get_additional_meta(url)
+		num, total = get_additional_meta(url, track_id=meta['id'])
 	parsed_meta = parse_meta(meta, total=total)
 	template = parse_template(parsed_meta, 
 		cfg['media_types']['track']['folder_template'], '{albumartist} - {album}')
@@ -375,62 +1058,201 @@ def track(meta, url, path=None, num=1, total=1):
 		track_path = os.path.join(path, template)
 	else:
 		track_path = os.path.join(cfg['output_path'], template)
-	print(track_folder)
+	tqdm.write(track_folder)
 	dir_setup(track_path)
 	iter_track([meta], track_path, parsed_meta, num_oride=num)
 
+def submit_track(meta, url, path, num, total):
+	# In queue mode, likes and artist tracks fan out into track jobs, so other workers
+	# share big collections. Sets stay whole, as their tracks need the set's metadata.
+	if job_queue == None:
+		return track(meta, url, path=path, num=num, total=total)
+	# The metadata goes along, so workers don't each look the track up again.
+	job_queue.put('track', str(meta['id']), json.dumps(
+		{'url': url, 'path': path, 'num': num, 'total': total, 'meta': meta}))
+	tqdm.write('Queued.')
+
+def run_job(kind, key, data):
+	# Only submits the job's tracks; they finish on the pipeline in their own time.
+	if kind == 'url':
+		media_type = check_url(key)
+		if media_type == None:
+			raise Exception('Invalid URL: ' + key)
+		return submit_url(key, media_type)
+	data = json.loads(data)
+	meta = data.get('meta')
+	if meta == None:
+		meta = client.get_tracks([int(key)]).get(int(key))
+	if meta == None:
+		raise Exception('Track not found: ' + key)
+	track(meta, data['url'], path=data['path'], num=data['num'], total=data['total'])
+
+def job_done(job_id, owner, stop, lost, slots, batch):
+	# Runs on whichever thread finished the job's last track.
+	stop.set()
+	try:
+		if lost.is_set():
+			tqdm.write('Lease lost; leaving job to its new owner.')
+		elif batch.error != None:
+			job_queue.fail(job_id, owner, batch.error)
+		elif batch.failed > 0:
+			job_queue.fail(job_id, owner, '{} track(s) failed.'.format(batch.failed))
+		else:
+			job_queue.ack(job_id, owner)
+	finally:
+		slots.release()
+
+def work_queue():
+	global job_batch
+	owner = '{}:{}'.format(platform.node(), os.getpid())
+	# Like the pipeline's transfer stage, up to track_workers jobs run at once, each acked
+	# or failed as soon as its own tracks are done.
+	max_jobs = max(cfg['track_workers'], 1)
+	slots = threading.BoundedSemaphore(max_jobs)
+	num = 0
+	while True:
+		slots.acquire()
+		job = job_queue.lease(owner)
+		if job == None:
+			slots.release()
+			break
+		num += 1
+		job_id, kind, key, data = job
+		tqdm.write('\nJob {} ({} {}):'.format(num, kind, key))
+		stop, lost = job_queue.keep_alive(job_id, owner)
+		batch = Batch(functools.partial(job_done, job_id, owner, stop, lost, slots))
+		job_batch = batch
+		error = None
+		try:
+			run_job(kind, key, data)
+		except KeyboardInterrupt:
+			# Left leased; it goes back to the queue once the lease runs out.
+			sys.exit()
+		except Exception as e:
+			err('Job failed.')
+			error = str(e)
+		finally:
+			job_batch = None
+		batch.close(error)
+	# Every slot back means every job has been acked or failed.
+	for _ in range(max_jobs):
+		slots.acquire()
+	counts = job_queue.counts()
+	print('\nQueue drained: {} done, {} pending or leased elsewhere, {} dead.'.format(
+		counts.get('done', 0), counts.get('pending', 0) + counts.get('leased', 0), counts.get('dead', 0)))
+
+def fmt_total(num, total):
+	# Paginated collections only have an estimated total up front.
+	if total == None:
+		return str(num)
+	return '{} of {}'.format(num, max(num, total))
+
+# Watch cycles a track can fail on before it's taken to be unavailable.
+MAX_TRACK_FAILURES = 3
+
+def can_stop_early(key):
+	# Only once a whole walk has gone through, or an interrupted first run would leave
+	# everything older than its newest tracks behind for good.
+	return cfg['watch_stop_after'] > 0 and cfg['watch'] > 0 and archive != None and archive.walked(key)
+
+def walk_finished(key):
+	if archive == None:
+		return
+	# Queue workers retry their own failed tracks. Otherwise it waits on the pipeline, as
+	# a track that fails further down would never be retried after an early stop.
+	if job_queue != None:
+		archive.set_walked(key)
+	else:
+		finished_walks[key] = True
+
+def archived_streak(_track, streak):
+	# Likes and artist tracks come newest first, so in watch mode a long enough run of
+	# archived tracks means the rest were fetched on an earlier cycle. Tracks that can't
+	# be fetched never reach the archive, so they're counted as well.
+	if is_archived(_track):
+		return streak + 1
+	elif 'media' in _track and unavailable_reason(_track) != None:
+		return streak + 1
+	elif track_failures.get(_track['id'], 0) >= MAX_TRACK_FAILURES:
+		return streak + 1
+	return 0
+
 def albums(artist_meta, _):
-	total = 0
+	num = 0
 	template = parse_template(artist_meta, 
 		cfg['media_types']['artist_albums']['folder_template'], '{username}')	
 	artist_path = os.path.join(cfg['output_path'], template)
-	print(artist_meta['username'] + '\'s albums')
+	tqdm.write(artist_meta['username'] + '\'s albums')
 	dir_setup(artist_path)
-	albums = client.get_artist_albums(str(artist_meta['id']))
-	for _album in albums:
-		total += len(_album)
-	if total == 0:
+	for num, album in enumerate(client.get_artist_albums(str(artist_meta['id'])), 1):
+		tqdm.write('\nAlbum {}:'.format(fmt_total(num, None)))
+		set(album, None, path=artist_path)
+	if num == 0:
 		raise Exception('Artist does not have any albums.')
-	for _album in albums:
-		for num, album in enumerate(_album, 1):
-			print('\nAlbum {} of {}:'.format(num, total))
-			set(album[0], path=artist_path)
 
 def likes(likes, _):
-	total = 0
+	num = 0
+	total = client.get_likes_count()
 	folder_name = cfg['media_types']['user_likes']['folder_name']
 	likes_path = os.path.join(
 		cfg['output_path'], folder_name)
-	print('Likes')
+	tqdm.write('Likes')
 	dir_setup(likes_path)
-	for like in likes:
-		total += len(like)
-	if total == 0:
+	walk_key = 'likes/' + client.get_user_id()
+	stop_early = can_stop_early(walk_key)
+	streak = 0
+	for num, _track in enumerate(likes, 1):
+		streak = archived_streak(_track['track'], streak)
+		if stop_early and streak >= cfg['watch_stop_after']:
+			tqdm.write('Caught up with the download archive.')
+			break
+		elif streak > 0:
+			continue
+		tqdm.write('\nTrack {}:'.format(fmt_total(num, total)))
+		submit_track(_track['track'], _, likes_path, 1, max(num, total or 0))
+	else:
+		walk_finished(walk_key)
+	if num == 0:
 		raise Exception('You do not have any likes.')
-	for like in likes:
-		for num, _track in enumerate(like, 1):
-			print('\nTrack {} of {}:'.format(num, total))
-			track(_track['track'], _, path=likes_path, total=total)
 
 def tracks(artist_meta, _):
-	total = 0
+	num = 0
+	total = artist_meta.get('track_count')
 	template = parse_template(artist_meta, 
 		cfg['media_types']['artist_albums']['folder_template'], '{username}')	
 	tracks_path = os.path.join(cfg['output_path'], template)
-	print(artist_meta['username'] + '\'s tracks')
+	tqdm.write(artist_meta['username'] + '\'s tracks')
 	dir_setup(tracks_path)
-	_tracks = client.get_artist_tracks(str(artist_meta['id']))
-	for _track in _tracks:
-		total += len(_track)
-	if total == 0:
+	walk_key = 'tracks/' + str(artist_meta['id'])
+	stop_early = can_stop_early(walk_key)
+	streak = 0
+	for num, _track in enumerate(client.get_artist_tracks(str(artist_meta['id'])), 1):
+		streak = archived_streak(_track, streak)
+		if stop_early and streak >= cfg['watch_stop_after']:
+			tqdm.write('Caught up with the download archive.')
+			break
+		elif streak > 0:
+			continue
+		tqdm.write('\nTrack {}:'.format(fmt_total(num, total)))
+		submit_track(_track, _, tracks_path, num, max(num, total or 0))
+	else:
+		walk_finished(walk_key)
+	if num == 0:
 		raise Exception('Artist does not have any tracks.')
-	for _track in _tracks:
-		for num, _track in enumerate(_track, 1):
-			print('\nTrack {} of {}:'.format(num, total))
-			track(_track, _, path=tracks_path, num=num, total=total)
 
-def main(url, media_type):
-	if media_type in ('albums', 'tracks'):
+def prefetch_meta(urls):
+	urls = [u for u in urls if check_url(u) in ('set', 'track')]
+	# A lone URL gains nothing from being resolved ahead.
+	if len(urls) < 2:
+		return {}
+	resolved = client.get_metadata_batch(urls)
+	# Failures are left for main() to hit again and report properly.
+	return {k: v for k, v in resolved.items() if not isinstance(v, Exception)}
+
+def submit_url(url, media_type, meta=None):
+	if meta != None:
+		pass
+	elif media_type in ('albums', 'tracks'):
 		meta = client.get_artist_info(url)
 	elif media_type == 'likes':
 		meta = client.get_user_likes()	
@@ -438,11 +1260,53 @@ def main(url, media_type):
 		meta = client.get_metadata(url)
 	globals()[media_type](meta, url)
 
-def cleanup():
-	for fname in os.listdir('sc-dl_tmp'):
-		os.remove(os.path.join('sc-dl_tmp', fname))
+def main(url, media_type, meta=None):
+	try:
+		submit_url(url, media_type, meta=meta)
+	finally:
+		failed = pipeline.wait()
+		if failed == 0:
+			for key in finished_walks:
+				archive.set_walked(key)
+		finished_walks.clear()
+	return failed
+
+def process_urls_once(urls):
+	urls = iter(urls)
+	batch = max(cfg['prefetch_urls'], 1)
+	resolved_ids = {}
+	num = 0
+	while True:
+		chunk = list(itertools.islice(urls, batch))
+		if not chunk:
+			break
+		prefetched = prefetch_meta(chunk) if cfg['prefetch_urls'] > 0 else {}
+		for url in chunk:
+			num += 1
+			print('\nItem {}:'.format(num))
+			media_type = check_url(url)
+			if media_type == None:
+				print('Invalid URL:', url)
+				continue
+			meta = prefetched.get(url)
+			try:
+				if cfg['dedupe_by_id'] == True and media_type in ('set', 'track'):
+					if meta == None:
+						meta = client.get_metadata(url)
+					# Catches the same track or set linked in ways canonicalizing can't see.
+					key = (meta['kind'], meta['id'])
+					if key in resolved_ids:
+						print('Already fetched via another URL.')
+						continue
+					resolved_ids[key] = True
+				main(url, media_type, meta=meta)
+			except KeyboardInterrupt:
+				sys.exit()
+			except Exception:
+				err('Item failed.')
 
 if __name__ == '__main__':
+	started = time.perf_counter()
 	is_win = platform.system() == 'Windows'
 	try:
 		if hasattr(sys, 'frozen'):
@@ -457,25 +1321,86 @@ if __name__ == '__main__':
 |__   |   --|___|  |  |  |__ 
 |_____|_____|   |____/|_____|
 	''')
+	stats = Stats()
 	cfg = parse_prefs()
-	dir_setup('sc-dl_tmp')
-	parsed = parse_cookies()
-	client = client.Client(parsed)
+	profiler = None
+	if cfg['profile']:
+		profiler = Profiler(cfg['profile'])
+	pipeline = make_pipeline()
+	if cfg['stage_stats'] == True:
+		pipeline.report(tqdm.write)
+	if cfg['live_stats'] == True:
+		stats.report_live(tqdm.write)
+	if cfg['bandwidth_limit'] != None:
+		bandwidth = BandwidthGovernor(cfg['bandwidth_limit'])
+	else:
+		bandwidth = BandwidthGovernor(cfg['bandwidth']['limit_mb'], schedule=cfg['bandwidth']['schedule'])
+	conns = threading.BoundedSemaphore(cfg['max_connections'])
+	cover_pool = ThreadPoolExecutor(max_workers=2)
+	covers = OrderedDict()
+	covers_lock = threading.Lock()
+	set_indexes = {}
+	set_indexes_lock = threading.Lock()
+	track_failures = {}
+	track_failures_lock = threading.Lock()
+	parsed = load_cookies()
+	cache = None
+	if cfg['cache']['enabled'] == True:
+		cache = Cache(cfg['cache']['path'], cfg['cache']['ttl'],
+			max_entries=cfg['cache']['max_entries'], refresh=cfg['refresh'])
+	client = client.Client(
+		parsed, pool_size=cfg['max_connections'], cache=cache, api_rate=cfg['rate_limit']['api'],
+		cdn_rate=cfg['rate_limit']['cdn'], seg_retries=cfg['segment_retries'], stats=stats,
+		base=cfg['api_base'], web_base=cfg['web_base'],
+		timeout=(cfg['timeout']['connect'], cfg['timeout']['read']))
+	job_queue = None
+	job_batch = None
+	finished_walks = {}
+	if cfg['queue']:
+		job_queue = JobQueue(cfg['queue'], lease_secs=cfg['queue_lease_secs'],
+			max_attempts=cfg['queue_max_attempts'])
+	archive = None
+	if cfg['archive_path']:
+		archive = Archive(cfg['archive_path'])
+	if cfg['import_archive']:
+		if archive == None:
+			raise Exception('Download archive is disabled in config.')
+		import_archive(cfg['import_archive'])
 	plan = client.get_plan()
 	is_go_plus = plan == 'Go+'
 	print('Signed in successfully - {} account.'.format(plan))
-	total = len(cfg['urls'])
-	for num, url in enumerate(cfg['urls'], 1):
-		print('\nItem {} of {}:'.format(num, total))
-		media_type = check_url(url)
-		if media_type == None:
-			print('Invalid URL:', url)
-			continue
+	stats.add_time('startup', time.perf_counter() - started)
+	while True:
+		if job_queue != None:
+			for url in process_urls(cfg['urls']):
+				job_queue.put('url', url, requeue=True)
+			work_queue()
+		else:
+			process_urls_once(process_urls(cfg['urls']))
+		if cfg['watch'] <= 0:
+			break
+		# Later cycles need to see new likes, tracks and set contents.
+		if cache != None:
+			cache.refresh = True
+		with set_indexes_lock:
+			set_indexes.clear()
+		print('\nWaiting {} secs until the next sync.'.format(cfg['watch']))
 		try:
-			main(url, media_type)
+			time.sleep(cfg['watch'])
 		except KeyboardInterrupt:
-			sys.exit()
-		except Exception:
-			err('Item failed.')
-		finally:
-			cleanup()
\ No newline at end of file
+			break
+	if cache != None:
+		cache.close()
+	if archive != None:
+		archive.close()
+	if job_queue != None:
+		job_queue.close()
+	if profiler != None:
+		profiler.stop()
+	if cfg['report']:
+		stats.write_report(cfg['report'])
+		print('\nWrote run report to ' + cfg['report'])
+	if cfg['pool_stats'] == True:
+		print('\nConnection pools:')
+		for pool in client.get_pool_stats():
+			print('{session} {host}: {connections} connections, {requests} requests'.format(**pool))
\ No newline at end of file
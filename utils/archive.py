@@ -0,0 +1,48 @@
+import time
+import sqlite3
+import threading
+
+
+class Archive():
+
+	def __init__(self, path):
+		self.lock = threading.Lock()
+		self.conn = sqlite3.connect(path, check_same_thread=False)
+		with self.conn:
+			self.conn.execute(
+				'CREATE TABLE IF NOT EXISTS archive (track_id INTEGER, quality INTEGER, '
+				'path TEXT, added REAL, PRIMARY KEY (track_id, quality))')
+			# Collections (likes, artist tracks) that have been gone through in full.
+			self.conn.execute('CREATE TABLE IF NOT EXISTS walks (key TEXT PRIMARY KEY, finished REAL)')
+		# Small enough to keep in memory, which makes lookups free. Only the best
+		# quality held for each track matters.
+		self.entries = dict(
+			self.conn.execute('SELECT track_id, MAX(quality) FROM archive GROUP BY track_id'))
+
+	def has(self, track_id, quality):
+		# Anything at or above the requested quality counts.
+		return self.entries.get(int(track_id), 0) >= quality
+
+	def add(self, track_id, quality, path):
+		with self.lock:
+			with self.conn:
+				self.conn.execute(
+					'INSERT OR REPLACE INTO archive VALUES (?, ?, ?, ?)',
+					(int(track_id), quality, path, time.time()))
+			self.entries[int(track_id)] = max(self.entries.get(int(track_id), 0), quality)
+
+	def walked(self, key):
+		with self.lock:
+			return self.conn.execute('SELECT 1 FROM walks WHERE key = ?', (key,)).fetchone() != None
+
+	def set_walked(self, key):
+		with self.lock:
+			with self.conn:
+				self.conn.execute('INSERT OR REPLACE INTO walks VALUES (?, ?)', (key, time.time()))
+
+	def __len__(self):
+		return len(self.entries)
+
+	def close(self):
+		with self.lock:
+			self.conn.close()
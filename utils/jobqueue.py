@@ -0,0 +1,137 @@
+import time
+import sqlite3
+import threading
+import traceback
+from contextlib import contextmanager
+
+
+class JobQueue():
+
+	# Jobs are (kind, key, data) rows that move pending -> leased -> done, or back to pending
+	# on failure until max_attempts, after which they're dead-lettered. A lease that isn't
+	# renewed by heartbeats runs out, so a crashed worker's job goes back to the others.
+	# sc-dl.py only uses put, lease, keep_alive, ack, fail and counts, so anything offering
+	# those can stand in for a queue shared some other way.
+	def __init__(self, path, lease_secs=300, max_attempts=3):
+		self.lease_secs = lease_secs
+		self.max_attempts = max_attempts
+		self.lock = threading.Lock()
+		# Manual transactions, and the default rollback journal rather than WAL, which
+		# doesn't work when the file is shared between hosts.
+		self.conn = sqlite3.connect(
+			path, timeout=60, check_same_thread=False, isolation_level=None)
+		self.conn.execute(
+			'CREATE TABLE IF NOT EXISTS jobs (id INTEGER PRIMARY KEY, kind TEXT, key TEXT, '
+			'data TEXT, state TEXT, attempts INTEGER, owner TEXT, lease_until REAL, '
+			'error TEXT, updated REAL, UNIQUE (kind, key))')
+		self.conn.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, id)')
+
+	@contextmanager
+	def transaction(self):
+		with self.lock:
+			# Taking the write lock up front keeps two workers from leasing the same job.
+			self.conn.execute('BEGIN IMMEDIATE')
+			try:
+				yield self.conn
+			except Exception:
+				self.conn.execute('ROLLBACK')
+				raise
+			self.conn.execute('COMMIT')
+
+	def put(self, kind, key, data=None, requeue=False):
+		# Jobs already in the queue are left alone, so finished work isn't redone. requeue
+		# puts finished ones back, e.g. a collection URL that's asked for again.
+		now = time.time()
+		with self.transaction() as conn:
+			conn.execute(
+				'INSERT OR IGNORE INTO jobs VALUES (NULL, ?, ?, ?, \'pending\', 0, NULL, 0, NULL, ?)',
+				(kind, key, data, now))
+			if requeue == True:
+				conn.execute(
+					'UPDATE jobs SET state = \'pending\', attempts = 0, data = ?, updated = ? '
+					'WHERE kind = ? AND key = ? AND state IN (\'done\', \'dead\')',
+					(data, now, kind, key))
+
+	def lease(self, owner):
+		now = time.time()
+		with self.transaction() as conn:
+			while True:
+				row = conn.execute(
+					'SELECT id, kind, key, data, attempts FROM jobs WHERE state = \'pending\' '
+					'OR (state = \'leased\' AND lease_until < ?) ORDER BY id LIMIT 1',
+					(now,)).fetchone()
+				if row == None:
+					return None
+				if row[4] >= self.max_attempts:
+					# Its last lease ran out, so the worker holding it died.
+					conn.execute(
+						'UPDATE jobs SET state = \'dead\', error = ?, updated = ? WHERE id = ?',
+						('Lease expired.', now, row[0]))
+					continue
+				conn.execute(
+					'UPDATE jobs SET state = \'leased\', attempts = attempts + 1, owner = ?, '
+					'lease_until = ?, updated = ? WHERE id = ?',
+					(owner, now + self.lease_secs, now, row[0]))
+				return row[:4]
+
+	def heartbeat(self, job_id, owner):
+		now = time.time()
+		with self.transaction() as conn:
+			return conn.execute(
+				'UPDATE jobs SET lease_until = ?, updated = ? '
+				'WHERE id = ? AND owner = ? AND state = \'leased\'',
+				(now + self.lease_secs, now, job_id, owner)).rowcount == 1
+
+	def keep_alive(self, job_id, owner):
+		# Renews the lease in the background until stop is set. lost is set once the lease
+		# is lost, either taken over by another worker or left to run out while renewals
+		# kept failing, and the job then belongs to someone else.
+		stop = threading.Event()
+		lost = threading.Event()
+		def _beat():
+			renewed = time.time()
+			while not stop.wait(self.lease_secs / 3):
+				try:
+					if self.heartbeat(job_id, owner) == False:
+						lost.set()
+						return
+					renewed = time.time()
+				except Exception:
+					print('Failed to renew lease on job {}.'.format(job_id))
+					traceback.print_exc()
+					if time.time() - renewed >= self.lease_secs:
+						lost.set()
+						return
+		t = threading.Thread(target=_beat, daemon=True)
+		t.start()
+		return stop, lost
+
+	@contextmanager
+	def held(self, job_id, owner):
+		# keep_alive for as long as the block runs, yielding lost.
+		stop, lost = self.keep_alive(job_id, owner)
+		try:
+			yield lost
+		finally:
+			stop.set()
+
+	def ack(self, job_id, owner):
+		with self.transaction() as conn:
+			conn.execute(
+				'UPDATE jobs SET state = \'done\', error = NULL, updated = ? WHERE id = ? AND owner = ?',
+				(time.time(), job_id, owner))
+
+	def fail(self, job_id, owner, error=None):
+		with self.transaction() as conn:
+			conn.execute(
+				'UPDATE jobs SET state = CASE WHEN attempts >= ? THEN \'dead\' ELSE \'pending\' END, '
+				'error = ?, updated = ? WHERE id = ? AND owner = ?',
+				(self.max_attempts, error, time.time(), job_id, owner))
+
+	def counts(self):
+		with self.lock:
+			return dict(self.conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state'))
+
+	def close(self):
+		with self.lock:
+			self.conn.close()
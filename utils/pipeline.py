@@ -0,0 +1,138 @@
+import time
+import itertools
+import threading
+import traceback
+from queue import Queue, PriorityQueue
+
+
+class Pipeline():
+
+	# stages: (name, func, workers, queue size). func(job, worker) returns the job for the next
+	# stage, or None to drop it. Each stage has its own worker threads and a bounded input
+	# queue, so a slow stage pushes back on the ones before it instead of piling up jobs.
+	# An optional fifth item, priority(job), makes that queue hand out the lowest key first.
+	def __init__(self, stages, on_error=None):
+		self.names = [stage[0] for stage in stages]
+		self.funcs = [stage[1] for stage in stages]
+		self.priorities = [stage[4] if len(stage) > 4 else None for stage in stages]
+		self.queues = [
+			PriorityQueue(maxsize=stage[3]) if self.priorities[i] != None else Queue(maxsize=stage[3])
+			for i, stage in enumerate(stages)]
+		# Breaks ties in arrival order and keeps jobs themselves from being compared.
+		self.seq = itertools.count()
+		self.busy = [0] * len(stages)
+		self.on_error = on_error
+		self.pending = 0
+		self.failed = 0
+		self.cond = threading.Condition()
+		for i, stage in enumerate(stages):
+			for worker in range(stage[2]):
+				t = threading.Thread(target=self._work, args=(i, worker), daemon=True)
+				t.start()
+
+	def _work(self, i, worker):
+		while True:
+			item = self.queues[i].get()
+			if self.priorities[i] != None:
+				item = item[2]
+			batch, job = item
+			with self.cond:
+				self.busy[i] += 1
+			passed = False
+			failed = False
+			try:
+				out = self.funcs[i](job, worker)
+				if out != None and i+1 < len(self.queues):
+					self._put(i+1, out, batch)
+					passed = True
+			except Exception:
+				failed = True
+				with self.cond:
+					self.failed += 1
+				# A failing handler mustn't take the worker down with it, or wait() never returns.
+				try:
+					if self.on_error != None:
+						self.on_error(self.names[i], job)
+				except Exception:
+					traceback.print_exc()
+			finally:
+				# Before pending drops, so whatever the batch does is done by the time wait() returns.
+				if passed == False and batch != None:
+					try:
+						batch.finish(failed)
+					except Exception:
+						traceback.print_exc()
+				with self.cond:
+					self.busy[i] -= 1
+					if passed == False:
+						self.pending -= 1
+						self.cond.notify_all()
+
+	def put(self, job, batch=None):
+		with self.cond:
+			self.pending += 1
+		if batch != None:
+			batch.add()
+		self._put(0, job, batch)
+
+	def _put(self, i, job, batch):
+		if self.priorities[i] == None:
+			self.queues[i].put((batch, job))
+		else:
+			self.queues[i].put((self.priorities[i](job), next(self.seq), (batch, job)))
+
+	def wait(self):
+		with self.cond:
+			while self.pending > 0:
+				self.cond.wait()
+			failed, self.failed = self.failed, 0
+		return failed
+
+	def depths(self):
+		with self.cond:
+			return [(name, q.qsize(), busy) for name, q, busy in zip(self.names, self.queues, self.busy)]
+
+	def report(self, write, interval=5):
+		def _report():
+			while True:
+				time.sleep(interval)
+				if self.pending > 0:
+					write('Stages: ' + ', '.join(
+						'{} {} queued/{} active'.format(*x) for x in self.depths()))
+		threading.Thread(target=_report, daemon=True).start()
+
+
+class Batch():
+
+	# A group of jobs put into a Pipeline, e.g. everything one queue job fans out into.
+	# on_done(batch) is called once the batch is closed and each of its jobs has finished,
+	# been dropped or failed; failed counts the last, and error is whatever close() was given.
+	def __init__(self, on_done):
+		self.on_done = on_done
+		self.lock = threading.Lock()
+		self.pending = 0
+		self.failed = 0
+		self.error = None
+		self.closed = False
+
+	def add(self):
+		with self.lock:
+			self.pending += 1
+
+	def finish(self, failed=False):
+		with self.lock:
+			self.pending -= 1
+			if failed == True:
+				self.failed += 1
+			done = self.closed and self.pending == 0
+		if done:
+			self.on_done(self)
+
+	def close(self, error=None):
+		# No more jobs will be added.
+		with self.lock:
+			self.closed = True
+			self.error = error
+			done = self.pending == 0
+		if done:
+			self.on_done(self)
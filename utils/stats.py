@@ -0,0 +1,139 @@
+import io
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+class Stats():
+
+	def __init__(self):
+		self.started = time.time()
+		self.lock = threading.Lock()
+		# name -> [count, total secs, max secs]
+		self.timings = {}
+		# host -> [requests, bytes]
+		self.hosts = {}
+
+	@contextmanager
+	def timed(self, name):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.add_time(name, time.perf_counter() - start)
+
+	def add_time(self, name, secs):
+		with self.lock:
+			timing = self.timings.setdefault(name, [0, 0.0, 0.0])
+			timing[0] += 1
+			timing[1] += secs
+			timing[2] = max(timing[2], secs)
+
+	def add_request(self, host, nbytes=0):
+		with self.lock:
+			counts = self.hosts.setdefault(host, [0, 0])
+			counts[0] += 1
+			counts[1] += nbytes
+
+	def add_bytes(self, host, nbytes):
+		with self.lock:
+			self.hosts.setdefault(host, [0, 0])[1] += nbytes
+
+	def summary(self):
+		with self.lock:
+			elapsed = time.time() - self.started
+			return {
+				'elapsed': round(elapsed, 3),
+				'timings': {
+					name: {
+						'count': count,
+						'total': round(total, 3),
+						'avg': round(total / count, 4),
+						'max': round(_max, 3)
+					} for name, (count, total, _max) in sorted(self.timings.items())},
+				'hosts': {
+					host: {
+						'requests': reqs,
+						'bytes': nbytes,
+						'mb_per_sec': round(nbytes / 1024**2 / max(elapsed, 0.001), 3)
+					} for host, (reqs, nbytes) in sorted(self.hosts.items())}
+			}
+
+	def format_summary(self):
+		summary = self.summary()
+		lines = ['{:.1f}s elapsed'.format(summary['elapsed'])]
+		for name, t in summary['timings'].items():
+			lines.append('  {}: {count} x {avg:.3f}s avg, {total:.1f}s total, {max:.2f}s max'.format(name, **t))
+		for host, h in summary['hosts'].items():
+			lines.append('  {}: {requests} requests, {:.1f} MB, {mb_per_sec:.2f} MB/s'.format(
+				host, h['bytes'] / 1024**2, **h))
+		return '\n'.join(lines)
+
+	def write_report(self, path):
+		summary = self.summary()
+		if not path.lower().endswith('.csv'):
+			with open(path, 'w', encoding='UTF-8') as f:
+				json.dump(summary, f, indent=4)
+			return
+		import csv
+		with open(path, 'w', newline='', encoding='UTF-8') as f:
+			writer = csv.writer(f)
+			writer.writerow(['kind', 'name', 'count', 'total_secs', 'avg_secs', 'max_secs', 'bytes'])
+			for name, t in summary['timings'].items():
+				writer.writerow(['timing', name, t['count'], t['total'], t['avg'], t['max'], ''])
+			for host, h in summary['hosts'].items():
+				writer.writerow(['host', host, h['requests'], '', '', '', h['bytes']])
+
+	def report_live(self, write, interval=10):
+		def _report():
+			while True:
+				time.sleep(interval)
+				write(self.format_summary())
+		threading.Thread(target=_report, daemon=True).start()
+
+
+class Profiler():
+
+	# Before 3.12, cProfile only sees the thread it's enabled in, so every thread started
+	# after this gets its own profile, and they're merged on stop. From 3.12 it runs on
+	# sys.monitoring, which covers every thread but allows one profiler. pyinstrument (.html)
+	# only covers the main thread. The profilers are imported here rather than at the
+	# top, so runs without --profile don't pay for them.
+	def __init__(self, path):
+		self.path = path
+		self.profiles = []
+		self.pyinstrument = None
+		if path.lower().endswith('.html'):
+			from pyinstrument import Profiler as PyinstrumentProfiler
+			self.pyinstrument = PyinstrumentProfiler()
+			self.pyinstrument.start()
+			return
+		if sys.version_info < (3, 12):
+			threading.setprofile(self._thread_start)
+		self._enable()
+
+	def _enable(self):
+		import cProfile
+		profile = cProfile.Profile()
+		self.profiles.append(profile)
+		profile.enable()
+
+	def _thread_start(self, frame, event, arg):
+		sys.setprofile(None)
+		self._enable()
+
+	def stop(self):
+		if self.pyinstrument != None:
+			self.pyinstrument.stop()
+			with open(self.path, 'w', encoding='UTF-8') as f:
+				f.write(self.pyinstrument.output_html())
+			return
+		import pstats
+		threading.setprofile(None)
+		self.profiles[0].disable()
+		merged = pstats.Stats(self.profiles[0], stream=io.StringIO())
+		for profile in self.profiles[1:]:
+			merged.add(profile)
+		merged.dump_stats(self.path)